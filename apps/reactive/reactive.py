@@ -1,7 +1,19 @@
 import hassapi
 import operator
+import asyncio
+import bisect
+import collections
+import contextlib
 import datetime
+import functools
+import heapq
+import json
+import math
+import os
+import pickle
 import re
+import sys
+import time
 
 
 class ExpressionError(Exception):
@@ -13,7 +25,11 @@ UNARY_OPERATORS = ('!',)
 
 
 class Expression:
-    def __init__(self, op, left, right):
+    # An n-ary expression: chains of the same operator, such as a | b | c,
+    # are kept in a single node.
+    __slots__ = ("operator", "operands", "_entities")
+
+    def __init__(self, op, *operands):
         if op == "&":
             self.operator = operator.and_
         elif op == "|":
@@ -23,27 +39,39 @@ class Expression:
         else:
             raise ExpressionError(f"Unknown operator {op}")
 
-        self.left = left
-        self.right = right
+        self.operands = list(operands)
+        self._entities = None
 
     def __repr__(self):
-        return f"({self.left} {self.operator.__name__} {self.right})"
+        return "(" + f" {self.operator.__name__} ".join(repr(o) for o in self.operands) + ")"
 
     def entities(self):
-        return self.left.entities() | self.right.entities()
+        # Expressions don't change once parsed, so this is only computed once
+        if self._entities is None:
+            self._entities = frozenset().union(*(o.entities() for o in self.operands))
+
+        return self._entities
 
-    def evaluate(self, states):
-        return self.operator(self.left.evaluate(states), self.right.evaluate(states))
+    def node(self, graph):
+        if self.operator is operator.and_:
+            op = all
+        elif self.operator is operator.or_:
+            op = any
+        else:
+            op = reduce_operator(self.operator)
+
+        return graph.node(op, tuple(graph.convert(o) for o in self.operands))
 
     def replace_aliases(self, aliases):
         return Expression(
             self.operator,
-            self.left.replace_aliases(aliases),
-            self.right.replace_aliases(aliases)
+            *(o.replace_aliases(aliases) for o in self.operands)
         )
 
 
 class UnaryExpression:
+    __slots__ = ("operator", "expr")
+
     def __init__(self, op, expr):
         self.operator = op
         self.expr = expr
@@ -54,26 +82,36 @@ class UnaryExpression:
     def entities(self):
         return self.expr.entities()
 
-    def evaluate(self, states):
-        return self.operator(self.expr.evaluate(states))
+    def node(self, graph):
+        if self.operator is operator.not_:
+            op = negate
+        else:
+            op = apply_operator(self.operator)
+
+        return graph.node(op, (graph.convert(self.expr),))
 
     def replace_aliases(self, aliases):
         return UnaryExpression(self.operator, self.expr.replace_aliases(aliases))
 
 
 class Entity:
+    __slots__ = ("name", "value", "_entities")
+
     def __init__(self, name, value=None):
-        self.name = name
-        self.value = value
+        # Entity names and values are interned, so the many copies of
+        # them in a large configuration share the same string object
+        self.name = sys.intern(name)
+        self.value = sys.intern(value) if value else value
+        self._entities = frozenset((self.name,))
 
     def __repr__(self):
         return f"{self.name}={self.value!r}" if self.value else self.name
 
     def entities(self):
-        return set((self.name,))
+        return self._entities
 
-    def evaluate(self, states):
-        return states.get(self.name) == (self.value or 'on')
+    def node(self, graph):
+        return graph.predicate(self.name, self.value or 'on')
 
     def replace_aliases(self, aliases):
         try:
@@ -82,7 +120,7 @@ class Entity:
             return self
 
         if self.value:
-            if isinstance(alias, Entity):
+            if type(alias) is Entity:
                 return Entity(alias.name, self.value)
 
             raise ExpressionError(
@@ -91,15 +129,100 @@ class Entity:
         return alias
 
 
-def parse_inputs(inputs, aliases=None):
-    tokens = list(
-        filter(lambda t: t != "", (t.strip()
-               for t in re.split("([&|()!])", inputs)))
-    )
+class TimedEntity(Entity):
+    # A state check with a time condition. "for" is true once the entity has
+    # had the state for the given number of seconds, "within" stays true for
+    # that long after the entity no longer has the state.
+    __slots__ = ("kind", "seconds")
+
+    def __init__(self, name, value, kind, seconds):
+        super().__init__(name, value)
+        self.kind = kind
+        self.seconds = seconds
+
+    def __repr__(self):
+        return f"{self.kind}:{self.seconds:g} {super().__repr__()}"
+
+    def node(self, graph):
+        return graph.timed_predicate(self.name, self.value or 'on', self.kind, self.seconds)
+
+    def replace_aliases(self, aliases):
+        try:
+            alias = aliases[self.name]
+        except KeyError:
+            return self
+
+        if type(alias) is not Entity:
+            raise ExpressionError("Time conditions can only refer to entity aliases")
+
+        return TimedEntity(alias.name, self.value or alias.value, self.kind, self.seconds)
+
+
+COMPARISONS = {
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+
+
+def to_number(state):
+    try:
+        return float(state)
+    except (TypeError, ValueError):
+        return None
+
 
-    expr, remainder = parse_expression(tokens)
-    if remainder:
-        raise ExpressionError(f"Unparsed tokens: {remainder}")
+class Comparison(Entity):
+    # A numeric comparison of an entity's state (or attribute) to a
+    # threshold. States that are not numbers, such as "unavailable", never
+    # compare true.
+    __slots__ = ("op", "threshold")
+
+    def __init__(self, name, op, threshold):
+        super().__init__(name)
+        self.op = op
+        self.threshold = threshold
+
+    def __repr__(self):
+        return f"{self.name}{self.op}{self.threshold:g}"
+
+    def node(self, graph):
+        return graph.comparison(self.name, self.op, self.threshold)
+
+    def replace_aliases(self, aliases):
+        try:
+            alias = aliases[self.name]
+        except KeyError:
+            return self
+
+        if type(alias) is not Entity or alias.value:
+            raise ExpressionError("Comparisons can only refer to entity aliases")
+
+        return Comparison(alias.name, self.op, self.threshold)
+
+
+TOKENS = re.compile(r"([&|()!])|([^&|()!]+)")
+
+# Binding strength of the operators. & binds tighter than |, and ! is
+# the tightest. In the legacy mode, & and | have the same precedence and
+# are right associative, so a & b | c means a & (b | c).
+PRECEDENCE = {"!": 3, "&": 2, "|": 1}
+LEGACY_PRECEDENCE = {"!": 3, "&": 1, "|": 1}
+
+
+def tokenize(inputs):
+    for op, entity in TOKENS.findall(inputs):
+        if op:
+            yield op
+        else:
+            entity = entity.strip()
+            if entity:
+                yield entity
+
+
+def parse_inputs(inputs, aliases=None, legacy=False):
+    expr = parse_expression(tokenize(inputs), legacy)
 
     if aliases:
         expr = expr.replace_aliases(aliases)
@@ -107,41 +230,128 @@ def parse_inputs(inputs, aliases=None):
     return expr
 
 
-def parse_binary_expression(op, left, tokens):
-    right, remainder = parse_expression(tokens)
-    return Expression(op, left, right), remainder
+def make_expression(op, left, right):
+    # Flatten chains of the same operator into a single n-ary expression.
+    # The operands are fresh from the parser, so they can be extended
+    # in place.
+    if isinstance(left, Expression) and left.operator is op:
+        if isinstance(right, Expression) and right.operator is op:
+            left.operands.extend(right.operands)
+        else:
+            left.operands.append(right)
+        return left
+
+    if isinstance(right, Expression) and right.operator is op:
+        right.operands.insert(0, left)
+        return right
 
+    return Expression(op, left, right)
 
-def parse_parenthesized_expression(tokens):
-    expr, remainder = parse_expression(tokens)
-    if not remainder or remainder[0] != ")":
-        raise ExpressionError("Expected ')'")
 
-    return expr, remainder[1:]
+def parse_expression(tokens, legacy=False):
+    # An iterative operator precedence (shunting-yard) parser, so that long
+    # expressions don't run into the recursion limit.
+    precedence = LEGACY_PRECEDENCE if legacy else PRECEDENCE
+    operands = []
+    operators = []
 
+    def reduce():
+        op = operators.pop()
+        if op == "!":
+            operands.append(UnaryExpression(operator.not_, operands.pop()))
+        else:
+            right = operands.pop()
+            left = operands.pop()
+            binop = operator.and_ if op == "&" else operator.or_
+            operands.append(make_expression(binop, left, right))
+
+    expect_operand = True
+
+    for token in tokens:
+        if token == "(":
+            if not expect_operand:
+                raise ExpressionError("Expected operator, got '('")
+            operators.append(token)
+
+        elif token == ")":
+            if expect_operand:
+                raise ExpressionError("Unexpected ')'")
+
+            while operators and operators[-1] != "(":
+                reduce()
+
+            if not operators:
+                raise ExpressionError("Unexpected ')'")
+            operators.pop()
+
+        elif token in UNARY_OPERATORS:
+            if not expect_operand:
+                raise ExpressionError(f"Expected operator, got '{token}'")
+            operators.append(token)
+
+        elif token in BINARY_OPERATORS:
+            if expect_operand:
+                raise ExpressionError("Expected entity, not operator")
+
+            # Operators of the same precedence are right associative in the
+            # legacy mode. (In the normal mode, & and | are associative, so
+            # grouping them either way gives the same flattened result.)
+            while operators and operators[-1] != "(" and (
+                precedence[operators[-1]] > precedence[token]
+                or (not legacy and precedence[operators[-1]] == precedence[token])
+            ):
+                reduce()
+
+            operators.append(token)
+            expect_operand = True
 
-def parse_unary_expression(op, tokens):
-    assert (op == '!')  # the only unary op supported ATM
+        else:
+            if not expect_operand:
+                raise ExpressionError(f"Expected operator, got '{token}'")
+            operands.append(parse_entity(token))
+            expect_operand = False
 
-    next = tokens[0]
+    if expect_operand:
+        raise ExpressionError("Expression truncated")
 
-    if next == "(":
-        operand, remainder = parse_parenthesized_expression(tokens[1:])
+    while operators:
+        if operators[-1] == "(":
+            raise ExpressionError("Expected ')'")
+        reduce()
 
-    elif next == ")":
-        raise ExpressionError("Unexpected ')'")
+    return operands[0]
 
-    elif next in BINARY_OPERATORS or next in UNARY_OPERATORS:
-        raise ExpressionError("Expected entity, not operator")
 
-    else:
-        operand = parse_entity(next)
-        remainder = tokens[1:]
+# Time conditions are written in front of the entity, e.g.
+# "for:5m binary_sensor.door=open" or "within:30s binary_sensor.motion"
+TIMED_ENTITY = re.compile(r"(for|within):(\d+(?:\.\d+)?)([smh]?)\s+(.+)")
+TIME_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600}
 
-    return UnaryExpression(operator.not_, operand), remainder
+# Numeric comparisons, e.g. "sensor.lux < 50". An entity's attributes are
+# referred to as "light.kitchen.brightness".
+COMPARISON = re.compile(r"(.+?)\s*(<=|>=|<|>)\s*(.*)")
 
 
 def parse_entity(token):
+    match = TIMED_ENTITY.fullmatch(token)
+    if match:
+        kind, amount, unit, token = match.groups()
+        entity = parse_entity(token)
+        if isinstance(entity, (TimedEntity, Comparison)):
+            raise ExpressionError(
+                f"Time conditions only apply to state checks: '{match.group(0)}'")
+
+        return TimedEntity(entity.name, entity.value, kind, float(amount) * TIME_UNITS[unit])
+
+    match = COMPARISON.fullmatch(token)
+    if match:
+        name, op, threshold = match.groups()
+        value = to_number(threshold)
+        if value is None:
+            raise ExpressionError(f"Expected a number, got '{threshold}'")
+
+        return Comparison(name, op, value)
+
     name = token
     value = None
 
@@ -151,68 +361,833 @@ def parse_entity(token):
     return Entity(name, value)
 
 
-def parse_expression(tokens):
-    if not tokens:
-        raise ExpressionError("Expression truncated")
+class Simplifier:
+    # Boolean simplification of parsed expressions: double negation,
+    # idempotence (a & a = a), complements (a & !a = false), absorption
+    # (a | a & b = a) and factoring (a & b | a & c = a & (b | c)).
+    # Parsed expressions can be shared (e.g. aliases and the parse cache), so
+    # they are never modified: unchanged sub-expressions are returned as is.
+    # Results are memoized by the identity of the expression, so an alias
+    # used in many rules is only simplified once per Simplifier.
+    def __init__(self):
+        self.keys = {}
+        self.results = {}
+        self.rules = {}
+
+    def key(self, e):
+        # A canonical form of the expression. The order of the operands
+        # of & and | doesn't matter.
+        cached = self.keys.get(id(e))
+        if cached is not None:
+            return cached[0]
+
+        if isinstance(e, TimedEntity):
+            k = f"{e.kind}:{e.seconds!r} {e.name}={e.value or 'on'}"
+        elif isinstance(e, Comparison):
+            k = f"{e.name}{e.op}{e.threshold!r}"
+        elif isinstance(e, Entity):
+            k = f"{e.name}={e.value or 'on'}"
+        elif isinstance(e, UnaryExpression):
+            k = f"{e.operator.__name__}({self.key(e.expr)})"
+        else:
+            operands = [self.key(o) for o in e.operands]
+            if e.operator is operator.and_ or e.operator is operator.or_:
+                operands.sort()
+            k = "(" + f" {e.operator.__name__} ".join(operands) + ")"
+
+        # Keep a reference, so the id isn't reused by another expression
+        self.keys[id(e)] = (k, e)
+        return k
+
+    def simplify(self, e):
+        # Returns the simplified expression, or True or False if the
+        # expression turns out to be constant
+        cached = self.results.get(id(e))
+        if cached is not None:
+            return cached[0]
+
+        if isinstance(e, Entity):
+            result = e
+        elif isinstance(e, UnaryExpression):
+            result = self.simplify_unary(e)
+        elif e.operator is operator.and_ or e.operator is operator.or_:
+            result = self.simplify_chain(e)
+        else:
+            result = e
+
+        self.results[id(e)] = (result, e)
+        return result
+
+    def simplify_unary(self, e):
+        # Other operators are left alone
+        if e.operator is not operator.not_:
+            return e
+
+        inner = self.simplify(e.expr)
+        if inner is True or inner is False:
+            return not inner
+        if is_negation(inner):
+            return inner.expr
+        return e if inner is e.expr else UnaryExpression(operator.not_, inner)
+
+    def simplify_chain(self, e):
+        key = self.key
+        op = e.operator
+        dual = operator.or_ if op is operator.and_ else operator.and_
+        # True is the identity of &, and is dropped from its operands, while
+        # False decides the result. The other way round for |.
+        identity = op is operator.and_
+
+        operands = {}
+        for o in e.operands:
+            o = self.simplify(o)
+            if o is identity:
+                continue
+            if o is (not identity):
+                return not identity
+
+            for o in (o.operands if isinstance(o, Expression) and o.operator is op else (o,)):
+                operands.setdefault(key(o), o)
+
+        for o in operands.values():
+            if is_negation(o) and key(o.expr) in operands:
+                return not identity
+
+        # An entity can only have one state at a time
+        if op is operator.and_:
+            expected = {}
+            for o in operands.values():
+                if type(o) is Entity:
+                    if expected.setdefault(o.name, o.value or "on") != (o.value or "on"):
+                        return False
+
+        def terms(o):
+            if isinstance(o, Expression) and o.operator is dual:
+                return {key(t) for t in o.operands}
+            return {key(o)}
+
+        # Absorption: a | a & b = a, and (a & b) | (a & b & c) = a & b
+        # (and the same with & and | swapped)
+        chains = {k: terms(o) for k, o in operands.items()
+                  if isinstance(o, Expression) and o.operator is dual}
+        absorbed = {
+            k for k, t in chains.items()
+            if not t.isdisjoint(operands) or any(u < t for u in chains.values())
+        }
+        result = [o for k, o in operands.items() if k not in absorbed]
+
+        # Factoring: a & b | a & c = a & (b | c)
+        if op is operator.or_ and len(result) > 1:
+            common = set.intersection(*(terms(o) for o in result))
+            if common:
+                factors = [t for t in result[0].operands if key(t) in common]
+                rest = []
+                for o in result:
+                    remaining = [t for t in o.operands if key(t) not in common]
+                    rest.append(remaining[0] if len(remaining) == 1
+                                else Expression(operator.and_, *remaining))
+
+                return self.simplify(
+                    Expression(operator.and_, *factors, Expression(operator.or_, *rest)))
+
+        if not result:
+            return identity
+        if len(result) == 1:
+            return result[0]
+        if len(result) == len(e.operands) and all(a is b for a, b in zip(result, e.operands)):
+            return e
+        return Expression(op, *result)
+
+    def simplify_rule(self, alternatives):
+        # The alternatives of an output rule are simplified as one | chain, so
+        # that terms are shared, absorbed or factored out across them. Returns
+        # the simplified alternatives, and True or False if the rule is
+        # constant (None otherwise.) Constant rules are kept as they are.
+        key = tuple(id(a) for a in alternatives)
+        cached = self.rules.get(key)
+        if cached is None:
+            cached = self.rules[key] = (self.simplify_alternatives(alternatives), alternatives)
+
+        result, constant = cached[0]
+        return list(result), constant
+
+    def simplify_alternatives(self, alternatives):
+        if len(alternatives) == 1:
+            expr = alternatives[0]
+        else:
+            expr = Expression(operator.or_, *alternatives)
+
+        result = self.simplify(expr)
+        if result is True or result is False:
+            return alternatives, result
+
+        if result is expr:
+            return alternatives, None
+
+        if isinstance(result, Expression) and result.operator is operator.or_:
+            return list(result.operands), None
+
+        return [result], None
 
-    next = tokens[0]
 
-    if next == "(":
-        entity, tokens = parse_parenthesized_expression(tokens[1:])
+def is_negation(expr):
+    return isinstance(expr, UnaryExpression) and expr.operator is operator.not_
 
-    elif next == ")":
-        raise ExpressionError("Unexpected ')'")
 
-    elif next in UNARY_OPERATORS:
-        entity, tokens = parse_unary_expression(next, tokens[1:])
+def simplify(expr):
+    return Simplifier().simplify(expr)
 
-    elif next in BINARY_OPERATORS:
-        raise ExpressionError("Expected entity, not operator")
 
-    else:
-        entity = parse_entity(next)
-        tokens = tokens[1:]
+def simplify_rule(alternatives):
+    return Simplifier().simplify_rule(alternatives)
 
-    if tokens:
-        if tokens[0] in BINARY_OPERATORS:
-            entity, tokens = parse_binary_expression(
-                tokens[0], entity, tokens[1:])
 
-        elif tokens[0] != ")":
-            raise ExpressionError(f"Expected operator, got {tokens}")
+class ParseCache:
+    # Memoizes parse_inputs. Results are keyed by the expression text and the
+    # definitions of the aliases it refers to, so when the app is reloaded
+    # only the rules and aliases that have changed are parsed again.
+    # The cache can also be saved to a file to survive restarts.
+    # The cached expressions are simplified by a Simplifier that lives as
+    # long as they do, so unchanged rules don't need to be simplified again.
+    VERSION = 2
 
-    return entity, tokens
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.used = set()
+        self.dirty = False
+        self.simplifier = Simplifier()
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+
+            if data.get("version") == self.VERSION:
+                self.entries = data["entries"]
+
+    def save(self):
+        if self.path and self.dirty:
+            with open(self.path, "wb") as f:
+                pickle.dump({"version": self.VERSION, "entries": self.entries}, f)
+
+            self.dirty = False
+
+    def parse(self, inputs, aliases=None, legacy=False):
+        key = (inputs, legacy)
+        self.used.add(key)
+        if key not in self.entries:
+            expr = parse_inputs(inputs, legacy=legacy)
+            self.entries[key] = (expr, frozenset(expr.entities()))
+            self.dirty = True
+
+        expr, names = self.entries[key]
+        if not aliases:
+            return expr
+
+        relevant = tuple(sorted(
+            (name, repr(aliases[name])) for name in names if name in aliases
+        ))
+        if not relevant:
+            return expr
+
+        key = (inputs, legacy, relevant)
+        self.used.add(key)
+        if key not in self.entries:
+            self.entries[key] = expr.replace_aliases(aliases)
+            self.dirty = True
+
+        return self.entries[key]
+
+    def prune(self):
+        # Forget the expressions that were not used since the last prune
+        if len(self.used) < len(self.entries):
+            self.entries = {k: v for k, v in self.entries.items() if k in self.used}
+            self.simplifier = Simplifier()
+            self.dirty = True
+
+        self.used = set()
+
+
+SNAPSHOT_VERSION = 1
+
+# The parse caches of each app instance. These outlive the app objects,
+# which are recreated whenever the app's configuration changes.
+parse_caches = {}
 
 
 class States:
+    # A mirror of the current entity states. It is seeded in bulk with a
+    # single get_state call and then kept up to date from the state change
+    # callbacks, so evaluating rules never has to call back into HA.
+    # Attributes are looked up as "light.kitchen.brightness", and their
+    # values are kept as strings like the states.
     def __init__(self, app):
         self.cache = {}
+        self.attributes = {}
         self.app = app
 
+    def refresh(self):
+        self.load(self.app.get_state())
+
+    def load(self, all_states):
+        all_states = all_states or {}
+        self.cache = {
+            entity: intern_state(state.get("state"))
+            for entity, state in all_states.items()
+        }
+        self.attributes = {
+            entity: state["attributes"]
+            for entity, state in all_states.items() if state.get("attributes")
+        }
+
+    def set(self, entity, state):
+        self.cache[entity] = intern_state(state)
+
+    def set_attribute(self, entity, attribute, value):
+        self.cache[f"{entity}.{attribute}"] = attribute_state(value)
+
     def get(self, entity):
-        if entity not in self.cache:
-            self.cache[entity] = self.app.get_state(entity)
+        try:
+            return self.cache[entity]
+        except KeyError:
+            pass
+
+        entity, attribute = split_attribute(entity)
+        if attribute is None:
+            return None
+
+        return attribute_state(self.attributes.get(entity, {}).get(attribute))
+
+
+def intern_state(state):
+    # States are interned like the values in the rules, so comparing them
+    # is usually just an identity check
+    return sys.intern(state) if isinstance(state, str) else state
+
+
+def attribute_state(value):
+    return None if value is None else intern_state(str(value))
+
+
+def split_attribute(name):
+    # "light.kitchen.brightness" is the brightness attribute of light.kitchen
+    domain, _, rest = name.partition(".")
+    entity, dot, attribute = rest.partition(".")
+    if not dot:
+        return name, None
+
+    return f"{domain}.{entity}", attribute
+
+
+def negate(values):
+    return not next(iter(values))
+
+
+def apply_operator(op):
+    return lambda values: op(*values)
+
+
+def reduce_operator(op):
+    return lambda values: functools.reduce(op, values)
+
+
+class Predicate:
+    # A leaf of the evaluation graph: does an entity have the given state?
+    __slots__ = ("entity", "expected", "parents", "value")
+    level = 0
+
+    def __init__(self, entity, value):
+        self.entity = entity
+        self.expected = value
+        self.parents = []
+        self.value = None
+
+    def __repr__(self):
+        return f"{self.entity}=={self.expected!r}"
+
+    def recompute(self, states):
+        return states.get(self.entity) == self.expected
+
+
+class TimedPredicate(Predicate):
+    # A leaf of the evaluation graph with a time condition. Its value depends
+    # on when the entity last started or stopped having the expected state,
+    # so besides state changes, it also changes when its deadline passes.
+    __slots__ = ("kind", "seconds", "clock", "matching", "changed_at")
+
+    def __init__(self, entity, value, kind, seconds, clock):
+        super().__init__(entity, value)
+        self.kind = kind
+        self.seconds = seconds
+        self.clock = clock
+        self.matching = False
+        self.changed_at = None
+
+    def __repr__(self):
+        return f"{self.kind}:{self.seconds:g} {super().__repr__()}"
+
+    def observe(self, state, now):
+        matching = state == self.expected
+        if matching != self.matching:
+            self.matching = matching
+            self.changed_at = now
+
+    def deadline(self):
+        # The time when the value will change unless the state changes first
+        if self.changed_at is None or self.matching != (self.kind == "for"):
+            return None
+
+        return self.changed_at + self.seconds
+
+    def recompute(self, states):
+        deadline = self.deadline()
+        if self.kind == "for":
+            return deadline is not None and self.clock() >= deadline
+
+        return self.matching or (deadline is not None and self.clock() < deadline)
+
+    def value_after(self, state):
+        # The value right after a (hypothetical) change to the given state
+        matching = state == self.expected
+        if matching == self.matching:
+            return self.value
+
+        if self.kind == "for":
+            return matching and self.seconds <= 0
+
+        # Either the state is matching now, or it just stopped matching
+        return self.seconds > 0 or matching
+
+
+class ThresholdPredicate(Predicate):
+    # A leaf of the evaluation graph comparing an entity's numeric state to
+    # a threshold
+    __slots__ = ("op", "compare")
+
+    def __init__(self, entity, op, threshold):
+        super().__init__(entity, threshold)
+        self.op = op
+        self.compare = COMPARISONS[op]
+
+    def __repr__(self):
+        return f"{self.entity}{self.op}{self.expected:g}"
+
+    def test(self, state):
+        value = to_number(state)
+        return value is not None and self.compare(value, self.expected)
+
+    def recompute(self, states):
+        return self.test(states.get(self.entity))
+
+
+class ThresholdIndex:
+    # The comparisons of one entity, sorted by their thresholds. Only the
+    # comparisons whose threshold lies between the old and the new value can
+    # change when the value changes, and those are found with a bisection.
+    def __init__(self):
+        self.thresholds = []
+        self.predicates = []
+
+    def add(self, predicate):
+        i = bisect.bisect_right(self.thresholds, predicate.expected)
+        self.thresholds.insert(i, predicate.expected)
+        self.predicates.insert(i, predicate)
 
-        return self.cache[entity]
+    def affected(self, old, new):
+        old = to_number(old)
+        new = to_number(new)
+        if old is None or new is None:
+            # Changes from or to a non-numeric state affect all comparisons
+            return self.predicates if (old is None) != (new is None) else ()
+
+        low, high = min(old, new), max(old, new)
+        return self.predicates[
+            bisect.bisect_left(self.thresholds, low):bisect.bisect_right(self.thresholds, high)]
+
+
+class Node:
+    # An inner node of the evaluation graph. The node caches the value it was
+    # last evaluated to, so recomputing it only needs the cached values of its
+    # children, never the states of the entities below them.
+    __slots__ = ("op", "children", "parents", "value", "level")
+
+    def __init__(self, op, children):
+        self.op = op
+        self.children = children
+        self.parents = []
+        self.value = None
+        self.level = max((c.level for c in children), default=0) + 1
+
+        for c in children:
+            c.parents.append(self)
+
+    def __repr__(self):
+        return f"{self.op.__name__}{self.children}"
+
+    def recompute(self, states):
+        return self.op(c.value for c in self.children)
+
+
+class OutputNode(Node):
+    # The root node of an output rule: the output is on if any of its
+    # alternatives evaluate to true
+    __slots__ = ("rule",)
+
+    def __init__(self, rule, children):
+        super().__init__(any, children)
+        self.rule = rule
+
+
+class BulkPlan:
+    # The evaluation graph flattened into a list of steps over bitsets, for
+    # evaluating all the rules in one pass, for one or many scenarios at
+    # once. Bit n of a node's value is the node's value in the n'th
+    # scenario, so each node is only visited once no matter how many
+    # scenarios there are.
+    def __init__(self, nodes):
+        index = {id(node): i for i, node in enumerate(nodes)}
+
+        self.size = len(nodes)
+        self.predicates = []
+        self.steps = []
+        self.outputs = []
+
+        self.timed = []
+        self.comparisons = []
+
+        for i, node in enumerate(nodes):
+            if isinstance(node, TimedPredicate):
+                self.timed.append((i, node))
+            elif isinstance(node, ThresholdPredicate):
+                self.comparisons.append((i, node))
+            elif isinstance(node, Predicate):
+                self.predicates.append((i, node.entity, node.expected))
+            else:
+                self.steps.append((i, node.op, tuple(index[id(c)] for c in node.children)))
+
+            if isinstance(node, OutputNode):
+                self.outputs.append((i, node.rule))
+
+    def run(self, states, scenarios=({},)):
+        # Each scenario is a dict of states that differ from the given states
+        full = (1 << len(scenarios)) - 1
+        values = [0] * self.size
+
+        overridden = {}
+        for bit, scenario in enumerate(scenarios):
+            for entity in scenario:
+                overridden.setdefault(entity, []).append(bit)
+
+        for i, entity, expected in self.predicates:
+            mask = full if states.get(entity) == expected else 0
+            for bit in overridden.get(entity, ()):
+                if scenarios[bit][entity] == expected:
+                    mask |= 1 << bit
+                else:
+                    mask &= ~(1 << bit)
+            values[i] = mask
+
+        for i, node in self.comparisons:
+            mask = full if node.test(states.get(node.entity)) else 0
+            for bit in overridden.get(node.entity, ()):
+                if node.test(scenarios[bit][node.entity]):
+                    mask |= 1 << bit
+                else:
+                    mask &= ~(1 << bit)
+            values[i] = mask
+
+        # Time conditions keep their current value, unless a scenario
+        # changes the state of their entity
+        for i, node in self.timed:
+            mask = full if node.value else 0
+            for bit in overridden.get(node.entity, ()):
+                if node.value_after(scenarios[bit][node.entity]):
+                    mask |= 1 << bit
+                else:
+                    mask &= ~(1 << bit)
+            values[i] = mask
+
+        for i, op, children in self.steps:
+            if op is all:
+                mask = full
+                for c in children:
+                    mask &= values[c]
+            elif op is any:
+                mask = 0
+                for c in children:
+                    mask |= values[c]
+            elif op is negate:
+                mask = full & ~values[children[0]]
+            else:
+                # Operators other than the ones the parser generates have
+                # to be evaluated one scenario at a time
+                mask = 0
+                for bit in range(len(scenarios)):
+                    if op(bool(values[c] >> bit & 1) for c in children):
+                        mask |= 1 << bit
+            values[i] = mask
+
+        return values
+
+    def evaluate(self, states, scenarios=({},)):
+        values = self.run(states, scenarios)
+        return {rule: values[i] for i, rule in self.outputs}
+
+
+class RuleGraph:
+    # The evaluation graph of all output rules. Structurally identical
+    # sub-expressions (e.g. aliases, but also any expression repeated
+    # in several rules) are represented by a single shared node.
+    # When an entity changes state, only the nodes on the paths from its
+    # predicates up to the output rules are recomputed, and propagation
+    # stops as soon as a node's value stays the same.
+    # The predicates of each entity are indexed by the value they check, so
+    # a state change only touches the predicates of the old and new states,
+    # no matter how many different values are checked. Likewise, a new
+    # reading of a numeric entity only touches the comparisons whose
+    # thresholds it crossed.
+    # Time conditions are tracked by TimedPredicates, whose deadlines are
+    # kept in a TimerWheel.
+    def __init__(self, timers=None, clock=time.time):
+        self.nodes = []
+        self.predicates = {}
+        self.entity_predicates = {}
+        self.entity_states = {}
+        self.timed_predicates = {}
+        self.entity_timed = {}
+        self.comparisons = {}
+        self.entity_thresholds = {}
+        self.timers = TimerWheel(clock()) if timers is None else timers
+        self.clock = clock
+        self.memo = {}
+        self.converted = {}
+        self.bulk_plan = None
+
+    def predicate(self, entity, value):
+        key = (entity, value)
+        if key not in self.predicates:
+            predicate = Predicate(entity, value)
+            self.predicates[key] = predicate
+            self.entity_predicates.setdefault(entity, {})[value] = predicate
+            self.nodes.append(predicate)
+
+        return self.predicates[key]
+
+    def timed_predicate(self, entity, value, kind, seconds):
+        key = (entity, value, kind, seconds)
+        if key not in self.timed_predicates:
+            predicate = TimedPredicate(entity, value, kind, seconds, self.clock)
+            self.timed_predicates[key] = predicate
+            self.entity_timed.setdefault(entity, []).append(predicate)
+            self.nodes.append(predicate)
+
+        return self.timed_predicates[key]
+
+    def comparison(self, entity, op, threshold):
+        key = (entity, op, threshold)
+        if key not in self.comparisons:
+            predicate = ThresholdPredicate(entity, op, threshold)
+            self.comparisons[key] = predicate
+            self.entity_thresholds.setdefault(entity, ThresholdIndex()).add(predicate)
+            self.nodes.append(predicate)
+
+        return self.comparisons[key]
+
+    def take_over_timers(self, old):
+        # Keep the progress of the time conditions of a previous graph, e.g.
+        # when the configuration is reloaded
+        for key, predicate in old.timed_predicates.items():
+            old.timers.cancel(predicate)
+            if key in self.timed_predicates:
+                self.timed_predicates[key].matching = predicate.matching
+                self.timed_predicates[key].changed_at = predicate.changed_at
+
+    def timer_states(self):
+        return {
+            repr(predicate): [predicate.matching, predicate.changed_at]
+            for predicate in self.timed_predicates.values()
+        }
+
+    def restore_timers(self, timers, inputs, states):
+        # Restore the progress of the time conditions saved by timer_states,
+        # for the entities whose state is still the same as when it was saved
+        for predicate in self.timed_predicates.values():
+            saved = timers.get(repr(predicate))
+            if (
+                saved is not None
+                and predicate.entity in inputs
+                and inputs[predicate.entity] == states.get(predicate.entity)
+            ):
+                predicate.matching, predicate.changed_at = saved
+
+    def observe(self, predicate, state, now):
+        predicate.observe(state, now)
+        self.schedule_deadline(predicate, now)
+
+    def schedule_deadline(self, predicate, now):
+        deadline = predicate.deadline()
+        if deadline is not None and deadline > now:
+            self.timers.schedule(predicate, deadline)
+        else:
+            self.timers.cancel(predicate)
+
+    def node(self, op, children):
+        # Children are already deduplicated, so their identities are enough
+        # to identify the expression. The order of operands of & and |
+        # doesn't matter.
+        if op is all or op is any:
+            key = (op, frozenset(id(c) for c in children))
+        else:
+            key = (op, tuple(id(c) for c in children))
+
+        if key not in self.memo:
+            self.memo[key] = Node(op, children)
+            self.nodes.append(self.memo[key])
+
+        return self.memo[key]
+
+    def convert(self, expr):
+        # Parsed expressions can be shared (e.g. aliases), so each one
+        # only needs to be converted once
+        key = id(expr)
+        if key not in self.converted:
+            self.converted[key] = expr.node(self)
+
+        return self.converted[key]
+
+    def add_rule(self, rule):
+        rule.node = OutputNode(rule, tuple(self.convert(i) for i in rule.input_states))
+        self.nodes.append(rule.node)
+
+    def plan(self):
+        if self.bulk_plan is None:
+            self.bulk_plan = BulkPlan(self.nodes)
+
+        return self.bulk_plan
+
+    def refresh(self, states):
+        # Nodes are created after their children, so the plan evaluates
+        # every node exactly once, bottom up. The clock is only read when
+        # there are time conditions, as reading it can be slow.
+        now = self.clock() if self.timed_predicates else None
+        for predicate in self.timed_predicates.values():
+            self.observe(predicate, states.get(predicate.entity), now)
+            predicate.value = predicate.recompute(states)
+
+        for node, value in zip(self.nodes, self.plan().run(states)):
+            node.value = value == 1
+
+        self.entity_states = {
+            e: states.get(e)
+            for e in (*self.entity_predicates, *self.entity_timed, *self.entity_thresholds)
+        }
+
+    def update(self, states, entities, evaluated=None):
+        # Recompute the predicates of the entities that changed state, and
+        # the nodes depending on them. If a list is given as evaluated, the
+        # rules whose outputs were recomputed are added to it.
+        changed = []
+        now = None
+
+        for entity in entities:
+            state = states.get(entity)
+            if entity in self.entity_states and state == self.entity_states[entity]:
+                continue
+
+            predicates = self.entity_predicates.get(entity, {})
+            thresholds = self.entity_thresholds.get(entity)
+            if entity not in self.entity_states:
+                changed.extend(predicates.values())
+                if thresholds is not None:
+                    changed.extend(thresholds.predicates)
+            else:
+                old = self.entity_states[entity]
+                for value in (old, state):
+                    if value in predicates:
+                        changed.append(predicates[value])
+
+                if thresholds is not None:
+                    changed.extend(thresholds.affected(old, state))
+
+            timed = self.entity_timed.get(entity)
+            if timed and now is None:
+                now = self.clock()
+            for predicate in timed or ():
+                self.observe(predicate, state, now)
+                changed.append(predicate)
+
+            self.entity_states[entity] = state
+
+        return self.propagate(states, changed, evaluated)
+
+    def expire(self, states, predicates, evaluated=None):
+        # Recompute time conditions whose deadline has passed. The clock can
+        # be slightly behind the timer wheel, in which case they are checked
+        # again on the next tick.
+        now = self.clock()
+        for predicate in predicates:
+            self.schedule_deadline(predicate, now)
+
+        return self.propagate(states, predicates, evaluated)
+
+    def propagate(self, states, predicates, evaluated=None):
+        # Recompute the affected nodes in order of their level so that a
+        # node shared by several paths is only recomputed once, after all
+        # its children are up to date.
+        pending = []
+        queued = set()
+
+        def enqueue(node):
+            if node not in queued:
+                queued.add(node)
+                heapq.heappush(pending, (node.level, id(node), node))
+
+        for predicate in predicates:
+            enqueue(predicate)
+
+        changed = []
+        while pending:
+            node = heapq.heappop(pending)[2]
+            value = node.recompute(states)
+            if evaluated is not None and isinstance(node, OutputNode):
+                evaluated.append(node.rule)
+
+            if value == node.value:
+                continue
+
+            node.value = value
+            if isinstance(node, OutputNode):
+                changed.append(node.rule)
+
+            for parent in node.parents:
+                enqueue(parent)
+
+        return changed
 
 
 class OutputRule:
-    def __init__(self, output_entity, input_states, aliases={}):
+    def __init__(self, output_entity, input_states, aliases={}, debounce=0, priority=0, legacy=False, parse=parse_inputs,
+                 simplify=simplify_rule):
         self.output_entity = output_entity
-        self.input_states = [parse_inputs(i, aliases) for i in input_states]
+        self.debounce = debounce
+        self.priority = priority
+        self.input_states, self.constant = simplify(
+            [parse(i, aliases, legacy) for i in input_states])
+        self.inputs = frozenset().union(*(i.entities() for i in self.input_states))
         self.last_state = None
+        self.node = None
 
     def __repr__(self):
         return f"{self.output_entity} = {self.input_states}"
 
-    def evaluate(self, states):
-        new_state = any(i.evaluate(states) for i in self.input_states)
-
-        if new_state is not self.last_state:
-            self.last_state = new_state
-            return new_state
-
-        return None
+    def matches(self, other):
+        return (
+            self.output_entity == other.output_entity
+            and self.debounce == other.debounce
+            and self.priority == other.priority
+            and repr(self.input_states) == repr(other.input_states)
+        )
 
     def update(self, hass):
         if self.last_state:
@@ -221,77 +1196,1086 @@ class OutputRule:
             hass.turn_off(self.output_entity)
 
 
-class Reactive(hassapi.Hass):
-    def initialize(self):
-        aliases = {
-            name: parse_inputs(expr)
-            for name, expr in self.args.get('aliases', {}).items()
+def priority(rule):
+    return rule.priority
+
+
+class TokenBucket:
+    # A rate limiter allowing on average rate events per second, in bursts
+    # of up to burst events
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(1, burst or rate)
+        self.tokens = self.burst
+        self.updated = None
+
+    def refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+
+        return False
+
+    def wait(self, now):
+        # Seconds until the next event is allowed
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class TimerWheel:
+    # A hashed timer wheel. Timers are kept in a ring of slots by the tick
+    # they expire on, so scheduling and cancelling a timer are O(1) and
+    # advancing the wheel only looks at the slots of the ticks that passed.
+    # Timers further away than one turn of the wheel stay in their slot
+    # until their tick comes around.
+    def __init__(self, now, resolution=1, size=256):
+        self.resolution = resolution
+        self.slots = [{} for _ in range(size)]
+        self.timers = {}
+        self.tick = math.floor(now / resolution)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, deadline):
+        # (Re)schedules the timer of key. A deadline that has already passed
+        # expires on the next tick.
+        self.cancel(key)
+        tick = max(math.ceil(deadline / self.resolution), self.tick + 1)
+        self.timers[key] = tick
+        self.slots[tick % len(self.slots)][key] = tick
+
+    def cancel(self, key):
+        tick = self.timers.pop(key, None)
+        if tick is not None:
+            del self.slots[tick % len(self.slots)][key]
+
+    def advance(self, now):
+        # Returns the keys of the timers that expired by now
+        current = math.floor(now / self.resolution)
+        ticks = min(current - self.tick, len(self.slots))
+        expired = []
+
+        for tick in range(current - ticks + 1, current + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key in [key for key, due in slot.items() if due <= current]:
+                del slot[key]
+                del self.timers[key]
+                expired.append(key)
+
+        self.tick = max(self.tick, current)
+        return expired
+
+
+class OutputScheduler:
+    # Sends the output commands. A command that would not change the state
+    # last sent to the output is dropped (unless forced.) If the output has a
+    # debounce window, further changes within the window after a command are
+    # held back and only the final state is sent when the window closes.
+    # Commands to low priority outputs (priority < 0) can be rate limited:
+    # when they come faster than the limit, they are deferred and sent
+    # later, in order.
+    # Held back and deferred commands are kept by output entity, and send
+    # the current rule of the output when they are due, as the rules may
+    # have been reconfigured in the meantime.
+    def __init__(self, hass, low_priority_rate=None):
+        self.hass = hass
+        self.sent = {}
+        self.windows = {}
+        self.pending = {}
+        self.low_priority = TokenBucket(low_priority_rate) if low_priority_rate else None
+        self.deferred = {}
+        self.drain_timer = None
+
+    def schedule(self, rule, force=False):
+        entity = rule.output_entity
+        if entity in self.windows:
+            self.pending[entity] = force or self.pending.get(entity, False)
+
+        elif entity in self.deferred:
+            self.deferred[entity] = force or self.deferred[entity]
+
+        elif (
+            rule.priority < 0
+            and self.low_priority is not None
+            and not self.low_priority.take(self.hass.now())
+        ):
+            self.deferred[entity] = force
+            self.schedule_drain()
+
+        else:
+            self.send(rule, force)
+
+    def schedule_drain(self):
+        if self.drain_timer is None:
+            self.drain_timer = self.hass.run_in(
+                self.drain, self.low_priority.wait(self.hass.now()))
+
+    def drain(self, kwargs):
+        self.drain_timer = None
+        self.hass.grouped(self.send_deferred, self.hass.now())
+
+        if self.deferred:
+            self.schedule_drain()
+
+    def send_deferred(self, now):
+        while self.deferred and self.low_priority.take(now):
+            entity = next(iter(self.deferred))
+            force = self.deferred.pop(entity)
+            rule = self.hass.output_rules.get(entity)
+            if rule is not None:
+                self.send(rule, force)
+
+    def send(self, rule, force=False):
+        entity = rule.output_entity
+        if not force and self.sent.get(entity) is rule.last_state:
+            return
+
+        self.sent[entity] = rule.last_state
+        self.hass.command(rule)
+        if self.hass.stats is not None:
+            self.hass.stats.record_command(entity)
+
+        if rule.debounce:
+            self.windows[entity] = self.hass.run_in(
+                self.window_closed, rule.debounce, entity=entity)
+
+    def window_closed(self, kwargs):
+        entity = kwargs["entity"]
+        del self.windows[entity]
+
+        force = self.pending.pop(entity, None)
+        rule = self.hass.output_rules.get(entity)
+        if force is not None and rule is not None:
+            self.send(rule, force)
+
+    def forget(self, entities):
+        # Drop the held back and deferred commands of removed outputs
+        for entity in entities:
+            self.pending.pop(entity, None)
+            self.deferred.pop(entity, None)
+            self.sent.pop(entity, None)
+
+
+class Stats:
+    # Counters and timings of the app's own work, for finding the rules and
+    # inputs responsible for latency. Counts are exact, but to keep the
+    # overhead low only every n'th event is timed. The time of an event is
+    # split evenly between the rules evaluated in it, and cumulative times
+    # are estimated from the sampled events.
+    SAMPLES = 200
+
+    def __init__(self, sample=1.0):
+        self.every = max(1, round(1 / sample))
+        self.events = 0
+        self.state_fetches = 0
+        self.commands = 0
+        self.inputs = {}
+        self.outputs = {}
+
+    def entry(self, table, key):
+        if key not in table:
+            table[key] = {
+                "events": 0,
+                "evaluations": 0,
+                "changes": 0,
+                "commands": 0,
+                "time": 0.0,
+                "times": collections.deque(maxlen=self.SAMPLES),
+            }
+
+        return table[key]
+
+    def sampled(self):
+        self.events += 1
+        return self.events % self.every == 0
+
+    def record_event(self, entities, evaluated, changed, elapsed=None):
+        for entity in entities:
+            e = self.entry(self.inputs, entity)
+            e["events"] += 1
+            e["evaluations"] += len(evaluated)
+            e["changes"] += len(changed)
+            if elapsed is not None:
+                e["time"] += elapsed * self.every / len(entities)
+                e["times"].append(elapsed / len(entities))
+
+        for rule in evaluated:
+            e = self.entry(self.outputs, rule.output_entity)
+            e["evaluations"] += 1
+            if elapsed is not None:
+                e["time"] += elapsed * self.every / len(evaluated)
+                e["times"].append(elapsed / len(evaluated))
+
+        for rule in changed:
+            self.entry(self.outputs, rule.output_entity)["changes"] += 1
+
+    def record_command(self, entity):
+        self.commands += 1
+        self.entry(self.outputs, entity)["commands"] += 1
+
+    @staticmethod
+    def summarize(entry):
+        times = sorted(entry["times"])
+        summary = {k: v for k, v in entry.items() if k != "times"}
+        summary["p95"] = times[int(len(times) * 0.95)] if times else None
+        return summary
+
+    def summary(self, top=None):
+        def table(entries):
+            summaries = sorted(
+                ((key, self.summarize(e)) for key, e in entries.items()),
+                key=lambda kv: kv[1]["p95"] or 0,
+                reverse=True,
+            )
+            return dict(summaries[:top] if top else summaries)
+
+        return {
+            "events": self.events,
+            "state_fetches": self.state_fetches,
+            "commands": self.commands,
+            "inputs": table(self.inputs),
+            "outputs": table(self.outputs),
         }
 
-        rules = [
-            OutputRule(out, inputs, aliases) for out, inputs in self.args["outputs"].items()
-        ]
+
+class TraceRecorder:
+    # Appends the state changes of the inputs to a JSON lines file, to be
+    # replayed offline (see tests/replay.py.) A trace starts with a header
+    # holding the states of the inputs and outputs, followed by one
+    # [time, entity, attribute, old, new] line per event. Events are only
+    # buffered when they happen, and are formatted and written in batches.
+    # Each run of the app appends a new header and its own events.
+    VERSION = 1
+
+    def __init__(self, path, buffer_size=1000):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.lines = []
+
+    def header(self, now, states):
+        self.flush()
+        self.lines.append(json.dumps({"version": self.VERSION, "time": now, "states": states}))
+
+    def record(self, now, entity, attribute, old, new):
+        self.buffer.append((now, entity, attribute, old, new))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        # Attribute values that aren't JSON (which HA doesn't send) are
+        # written as strings rather than blocking the trace
+        self.lines.extend(json.dumps(event, default=str) for event in self.buffer)
+        self.buffer = []
+        if self.lines:
+            lines = self.lines
+            self.lines = []
+            with open(self.path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+
+
+def group_commands(commands):
+    # Groups (entity, state) commands by target state, keeping only the
+    # last command to each entity. The groups are in the order of their
+    # first command, so the most urgent ones still go first.
+    latest = {}
+    for entity, state in commands:
+        latest[entity] = state
+
+    groups = {}
+    for entity, state in latest.items():
+        groups.setdefault(state, []).append(entity)
+
+    return groups
+
+
+def grouping_commands(method):
+    # Collects the output commands of a callback, to send them grouped when
+    # it returns (see Reactive.grouped)
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        return self.grouped(method, self, *args)
+
+    return wrapper
+
+
+class Reactive(hassapi.Hass):
+    scheduler_class = OutputScheduler
+
+    def initialize(self):
+        cache_path = self.args.get("parse_cache")
+        self.parse_cache = parse_caches.get(self.name)
+        if self.parse_cache is None or self.parse_cache.path != cache_path:
+            self.parse_cache = parse_caches[self.name] = ParseCache(cache_path)
+            try:
+                self.parse_cache.load()
+            except Exception as e:
+                self.log(f"Could not load parse cache: {e}")
 
         # self.output_rules is an index that maps each output entity to its corresponding
         # set of rules. This is used when an output entity has been unavailable and
         # becomes available again to update its state.
-        self.output_rules = {r.output_entity: r for r in rules}
+        self.output_rules = {}
 
         # self.rules is an index that maps each mentioned entity to the rules
-        # it appears in. It is used to re-evaluate all relevant rules when
-        # an entity changes state.
+        # it appears in.
         self.rules = {}
 
-        all_inputs = set()
-        for rule in rules:
-            inputs = set()
-            for i in rule.input_states:
-                inputs |= i.entities()
+        # Listener handles of the input and output entities
+        self.input_listeners = {}
+        self.output_listeners = {}
+
+        # Commands collected while a callback runs, see grouped
+        self.outbox = None
+        self.scheduler = self.scheduler_class(self, self.args.get("low_priority_rate"))
+        self.batched = set()
+        self.batch_timer = None
+
+        # All time conditions share one timer wheel, which is driven by a
+        # single AppDaemon timer while any of them is pending
+        self.timers = TimerWheel(self.now(), self.args.get("timer_resolution", 1))
+        self.timer_handle = None
+        self.graph = None
+
+        rate = self.args.get("availability_rate")
+        self.recovery_limit = TokenBucket(rate) if rate else None
+        self.recovering = {}
+        self.recovery_timer = None
+
+        # Optional instrumentation of the app's own performance
+        stats = self.args.get("stats")
+        if stats:
+            stats = stats if isinstance(stats, dict) else {}
+            self.stats = Stats(stats.get("sample", 1.0))
+            self.stats_file = stats.get("file")
+            self.stats_top = stats.get("top", 10)
+            self.run_every(self.publish_stats, f"now+{stats.get('interval', 300)}",
+                           stats.get("interval", 300))
+            self.listen_event(self.dump_stats, "reactive_dump_stats")
+        else:
+            self.stats = None
+
+        # Optional recording of the input events, for replaying them offline
+        trace = self.args.get("trace")
+        if trace:
+            trace = trace if isinstance(trace, dict) else {"file": trace}
+            self.trace = TraceRecorder(trace["file"], trace.get("buffer", 1000))
+            self.run_every(self.flush_trace_callback, f"now+{trace.get('interval', 5)}",
+                           trace.get("interval", 5))
+        else:
+            self.trace = None
+
+        # The snapshot of the rule states saved before a restart, if any
+        self.snapshot_path = self.args.get("snapshot")
+        self.snapshot_timer = None
+        self.snapshot = self.load_snapshot()
+
+        self.states = States(self)
+        self.fetch_states(self.states)
+
+        # Set up the rules. On startup, all of them are new, so all the
+        # outputs are set to the state their rules evaluate to.
+        self.reconfigure(self.args)
+
+        if self.trace is not None:
+            self.trace.header(self.now(), {
+                entity: self.states.get(entity)
+                for entity in (*self.rules, *self.output_rules)
+            })
+
+        # Periodically make sure things haven't drifted out of sync.
+        # The periodic sync also reloads the state mirror in case a
+        # state change was missed.
+        self.run_hourly(
+            self.trigger_all,
+            datetime.time(0, 0, 30),
+            reconcile=self.args.get("reconcile", True),
+            diff=True,
+        )
 
-            all_inputs |= inputs
-            for i in inputs:
+    @grouping_commands
+    def reconfigure(self, args):
+        # Apply a new configuration. Only the listeners of inputs and outputs
+        # that were added or removed are changed, and only the new or changed
+        # rules are (re)sent to their outputs. Unchanged rules keep their state.
+        self.args = args
+
+        legacy = self.args.get("legacy_precedence", False)
+        aliases = {
+            name: self.parse_cache.parse(expr, legacy=legacy)
+            for name, expr in self.args.get('aliases', {}).items()
+        }
+
+        new_rules = []
+        rules = []
+        for out, config in self.args["outputs"].items():
+            rule = self.make_rule(out, config, aliases)
+            old_rule = self.output_rules.get(out)
+            if old_rule is not None and old_rule.matches(rule):
+                rules.append(old_rule)
+            else:
+                rules.append(rule)
+                new_rules.append(rule)
+
+        removed = self.output_rules.keys() - self.args["outputs"].keys()
+
+        self.parse_cache.prune()
+        try:
+            self.parse_cache.save()
+        except OSError as e:
+            self.log(f"Could not save parse cache: {e}")
+
+        self.output_rules = {r.output_entity: r for r in rules}
+        self.scheduler.forget(removed)
+
+        self.rules = {}
+        for rule in rules:
+            for i in rule.inputs:
                 self.rules.setdefault(i, []).append(rule)
 
-            self.log(f"{rule.output_entity} affected by {len(inputs)} input entities"
+        for rule in new_rules:
+            self.log(f"{rule.output_entity} affected by {len(rule.inputs)} input entities"
                      )
+            if rule.constant is not None:
+                self.log(f"{rule.output_entity} is always {'on' if rule.constant else 'off'}, "
+                         "its inputs can't change its state")
 
-        self.log(f"Listening to {len(all_inputs)} inputs total.")
-        self.listen_state(self.input_changed, list(all_inputs))
+        old_graph = self.graph
+        self.graph = RuleGraph(self.timers, self.now)
+        for rule in rules:
+            self.graph.add_rule(rule)
 
-        # Trigger all the rules on startup and periodically to
-        # ensure things haven't drifted out of sync
-        self.trigger_all({"rules": rules})
-        self.run_hourly(self.trigger_all, datetime.time(0, 0, 30), rules=rules)
+        if old_graph is not None:
+            self.graph.take_over_timers(old_graph)
+
+        self.log(f"Evaluation graph has {len(self.graph.nodes)} nodes.")
+
+        # The mirror is only kept up to date for the inputs that are listened
+        # to, so the states of new inputs have to be fetched
+        added_inputs = self.rules.keys() - self.input_listeners.keys()
+        self.update_listeners(
+            self.input_listeners, self.rules.keys(), self.input_changed)
 
         # Refresh state when output becomes available
-        self.listen_state(
+        self.update_listeners(
+            self.output_listeners,
+            self.output_rules.keys(),
             self.output_becomes_available,
-            [r.output_entity for r in rules],
             old="unavailable",
         )
 
+        self.log(f"Listening to {len(self.input_listeners)} inputs total.")
+
+        self.chain_ranks = self.order_chains(rules)
+
+        # After a restart, the outputs that still have the state they had
+        # before it are left alone
+        snapshot, self.snapshot = self.snapshot or {}, None
+        previous = snapshot.get("outputs", {})
+        if snapshot:
+            self.graph.restore_timers(
+                snapshot.get("timers", {}), snapshot.get("inputs", {}), self.states)
+
+        # (On startup, the states were just fetched)
+        if added_inputs and old_graph is not None:
+            self.fetch_states(self.states)
+
+        self.graph.refresh(self.states)
+        self.propagate_outputs(rules)
+        added = set(new_rules)
+        restored = 0
+        for rule in sorted(rules, key=priority, reverse=True):
+            if rule in added:
+                rule.last_state = rule.node.value
+                if previous.get(rule.output_entity) is rule.last_state:
+                    self.scheduler.sent[rule.output_entity] = rule.last_state
+                    restored += 1
+                else:
+                    self.scheduler.schedule(rule, force=True)
+
+            elif rule.node.value is not rule.last_state:
+                rule.last_state = rule.node.value
+                self.scheduler.schedule(rule)
+
+        self.schedule_timers()
+        self.schedule_snapshot()
+        self.log(f"{len(new_rules)} rules added or changed, {len(removed)} removed.")
+        if snapshot:
+            self.log(f"{restored} outputs restored from the snapshot, "
+                     f"{len(new_rules) - restored} sent.")
+
+    def request_reconfigure(self, args):
+        # For other apps: reconfigure swaps the rules and the graph that this
+        # app's callbacks use, so it is run as one of them, on this app's
+        # thread, rather than on the caller's
+        self.run_in(self.reconfigure_callback, 0, args=args)
+
+    def reconfigure_callback(self, kwargs):
+        self.reconfigure(kwargs["args"])
+
+    def order_chains(self, rules):
+        # Outputs that are inputs of other rules are chained locally (see
+        # propagate_outputs.) They are ranked in topological order, so an
+        # output is only propagated after all the outputs it depends on.
+        # Rules that form a cycle are left to be chained through HA, as
+        # propagating them locally might never settle.
+        chained = {rule.output_entity for rule in rules if rule.output_entity in self.rules}
+        if not chained:
+            return {}
+
+        depends = {
+            rule.output_entity: rule.inputs & chained
+            for rule in rules if rule.output_entity in chained
+        }
+        dependents = {}
+        for entity, inputs in depends.items():
+            for i in inputs:
+                dependents.setdefault(i, []).append(entity)
+
+        waiting = {entity: len(inputs) for entity, inputs in depends.items()}
+        ready = [entity for entity, count in waiting.items() if count == 0]
+        ranks = {}
+        while ready:
+            entity = ready.pop()
+            ranks[entity] = max((ranks[i] for i in depends[entity]), default=-1) + 1
+            for dependent in dependents.get(entity, ()):
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(ranks) < len(chained):
+            cycle = sorted(chained - set(ranks))
+            self.log(f"Outputs {', '.join(cycle)} depend on each other in a cycle (or on such outputs), "
+                     "they are chained through Home Assistant.")
+
+        return ranks
+
+    def update_listeners(self, listeners, entities, callback, **kwargs):
+        entities = set(entities)
+
+        for entity in set(listeners) - entities:
+            self.cancel_listen_state(listeners.pop(entity))
+
+        for name in entities - set(listeners):
+            entity, attribute = split_attribute(name)
+            if attribute is None:
+                listeners[name] = self.listen_state(callback, entity, **kwargs)
+            else:
+                listeners[name] = self.listen_state(
+                    callback, entity, attribute=attribute, **kwargs)
+
+    def make_rule(self, output, config, aliases):
+        # An output is configured either with just its list of input rules,
+        # or with a dict of settings including the rules
+        if not isinstance(config, dict):
+            config = {"inputs": config}
+
+        return OutputRule(
+            output,
+            config["inputs"],
+            aliases,
+            debounce=config.get("debounce", self.args.get("debounce", 0)),
+            priority=config.get("priority", 0),
+            legacy=self.args.get("legacy_precedence", False),
+            parse=self.parse_cache.parse,
+            simplify=self.parse_cache.simplifier.simplify_rule,
+        )
+
+    @grouping_commands
     def trigger_all(self, cb_args):
-        rules = cb_args["rules"]
-        states = States(self)
+        rules = sorted(self.output_rules.values(), key=priority, reverse=True)
+        if cb_args.get("reconcile"):
+            self.fetch_states(self.states)
+            # Chaining updates the outputs in the mirror, so their actual
+            # states are kept for finding the drifted ones
+            current = {rule.output_entity: self.states.get(rule.output_entity) for rule in rules}
+
+        self.graph.refresh(self.states)
+        self.propagate_outputs(rules)
+        self.schedule_timers()
         for rule in rules:
-            rule.evaluate(states)
-            rule.update(self)
+            rule.last_state = rule.node.value
+
+        if not cb_args.get("diff"):
+            for rule in rules:
+                self.scheduler.schedule(rule, force=True)
+            return
+
+        # Only send commands to the outputs whose actual state has drifted
+        # from what their rules say, spread out over the configured period
+        # to avoid a burst of traffic.
+        if not cb_args.get("reconcile"):
+            current = States(self)
+            self.fetch_states(current)
+
+        drifted = [
+            rule for rule in rules
+            if current.get(rule.output_entity) != "unavailable"
+            and current.get(rule.output_entity) != ("on" if rule.last_state else "off")
+        ]
 
+        spread = self.args.get("resync_spread", 0)
+        for i, rule in enumerate(drifted):
+            delay = spread * i / len(drifted)
+            if delay:
+                self.run_in(self.resync_output, delay, entity=rule.output_entity)
+            else:
+                self.scheduler.schedule(rule, force=True)
+
+        self.log(f"Periodic sync: {len(drifted)} of {len(rules)} outputs had drifted.")
+
+    @grouping_commands
+    def resync_output(self, kwargs):
+        rule = self.output_rules.get(kwargs["entity"])
+        if rule is not None:
+            self.scheduler.schedule(rule, force=True)
+
+    @grouping_commands
     def input_changed(self, entity, attribute, old, new, kwargs):
-        affected_rules = self.rules[entity]
-        states = States(self)
+        if self.trace is not None:
+            self.trace.record(self.now(), entity, attribute, old, new)
 
-        changes = 0
-        for rule in affected_rules:
-            change = rule.evaluate(states)
-            if change is not None:
-                rule.update(self)
-                changes += 1
+        if attribute is None or attribute == "state":
+            self.states.set(entity, new)
+        else:
+            self.states.set_attribute(entity, attribute, new)
+            entity = f"{entity}.{attribute}"
+
+        # In batching mode, changes are collected for a short while and
+        # the affected rules are evaluated just once for the whole batch
+        batch = self.args.get("batch", 0)
+        if batch:
+            self.batched.add(entity)
+            if self.batch_timer is None:
+                self.batch_timer = self.run_in(self.process_batch, batch)
+            return
+
+        affected_rules = self.rules.get(entity, ())
+        changes = self.apply_changes((entity,))
 
         if changes > 0:
             self.log(f"{entity} ({old} -> {new}): {len(affected_rules)} rules triggered, {changes} output states changed."
                      )
 
+    @grouping_commands
+    def process_batch(self, kwargs):
+        entities = self.batched
+        self.batched = set()
+        self.batch_timer = None
+
+        affected_rules = set()
+        for entity in entities:
+            affected_rules.update(self.rules.get(entity, ()))
+
+        changes = self.apply_changes(entities)
+
+        if changes > 0:
+            self.log(f"{len(entities)} inputs changed: {len(affected_rules)} rules triggered, {changes} output states changed."
+                     )
+
+    def apply_changes(self, entities):
+        if self.stats is None:
+            evaluated = None
+            changed_rules = self.graph.update(self.states, entities)
+        else:
+            sampled = self.stats.sampled()
+            start = time.perf_counter() if sampled else None
+            evaluated = []
+            changed_rules = self.graph.update(self.states, entities, evaluated)
+
+        changed_rules = self.propagate_outputs(changed_rules, evaluated)
+        self.schedule_changes(changed_rules)
+        self.schedule_timers()
+        self.schedule_snapshot()
+
+        if self.stats is not None:
+            elapsed = time.perf_counter() - start if sampled else None
+            self.stats.record_event(entities, evaluated, changed_rules, elapsed)
+
+        return len(changed_rules)
+
+    def propagate_outputs(self, changed_rules, evaluated=None):
+        # When the output of a rule is also an input of other rules, its new
+        # state is put into the state mirror right away, so the dependent
+        # rules are evaluated in the same callback instead of after a round
+        # trip through HA. The commands are still sent as usual. Returns the
+        # rules whose state differs from their last state after all the
+        # chained outputs have been propagated.
+        pending = [
+            (self.chain_ranks[rule.output_entity], rule.output_entity)
+            for rule in changed_rules if rule.output_entity in self.chain_ranks
+        ]
+        if not pending:
+            return changed_rules
+
+        heapq.heapify(pending)
+        changed = dict.fromkeys(changed_rules)
+        while pending:
+            entity = heapq.heappop(pending)[1]
+            state = "on" if self.output_rules[entity].node.value else "off"
+            if self.states.get(entity) == state:
+                continue
+
+            self.states.set(entity, state)
+            for rule in self.graph.update(self.states, (entity,), evaluated):
+                changed[rule] = None
+                if rule.output_entity in self.chain_ranks:
+                    heapq.heappush(
+                        pending, (self.chain_ranks[rule.output_entity], rule.output_entity))
+
+        return [rule for rule in changed if rule.node.value is not rule.last_state]
+
+    def schedule_changes(self, changed_rules):
+        # Send the commands of the most urgent outputs first
+        changed_rules.sort(key=priority, reverse=True)
+        for rule in changed_rules:
+            rule.last_state = rule.node.value
+            self.scheduler.schedule(rule)
+
+    def now(self):
+        # The current time, for the time conditions and rate limits.
+        # AsyncReactive overrides this, as AppDaemon's calls return
+        # awaitables in async callbacks.
+        return self.get_now_ts()
+
+    def schedule_timers(self):
+        if self.timers and self.timer_handle is None:
+            self.timer_handle = self.run_in(self.advance_timers, self.timers.resolution)
+
+    @grouping_commands
+    def advance_timers(self, kwargs):
+        self.timer_handle = None
+        expired = self.timers.advance(self.now())
+
+        if expired:
+            changed_rules = self.propagate_outputs(self.graph.expire(self.states, expired))
+            self.schedule_changes(changed_rules)
+            self.schedule_snapshot()
+            if changed_rules:
+                self.log(f"{len(expired)} time conditions expired, {len(changed_rules)} output states changed.")
+
+        self.schedule_timers()
+
+    def load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            self.log(f"Could not load snapshot: {e}")
+            return None
+
+        return snapshot if snapshot.get("version") == SNAPSHOT_VERSION else None
+
+    def schedule_snapshot(self):
+        # Snapshots are written at most once per snapshot_interval seconds
+        if self.snapshot_path and self.snapshot_timer is None:
+            self.snapshot_timer = self.run_in(
+                self.save_snapshot_callback, self.args.get("snapshot_interval", 10))
+
+    def save_snapshot_callback(self, kwargs):
+        self.snapshot_timer = None
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "outputs": {
+                entity: rule.last_state for entity, rule in self.output_rules.items()
+            },
+            "inputs": {entity: self.states.get(entity) for entity in self.rules},
+            "timers": self.graph.timer_states(),
+        }
+
+        # Written to a temporary file first, so a crash while writing
+        # doesn't leave a truncated snapshot behind
+        try:
+            with open(self.snapshot_path + ".tmp", "w") as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+            os.replace(self.snapshot_path + ".tmp", self.snapshot_path)
+        except OSError as e:
+            self.log(f"Could not save snapshot: {e}")
+
+    def flush_trace_callback(self, kwargs):
+        self.flush_trace()
+
+    def flush_trace(self):
+        try:
+            self.trace.flush()
+        except OSError as e:
+            self.log(f"Could not write trace: {e}")
+
+    def terminate(self):
+        if self.snapshot_path:
+            self.save_snapshot()
+
+        if self.trace is not None:
+            self.flush_trace()
+
+    def what_if(self, scenarios):
+        # Evaluate all the rules for hypothetical states, given as a list
+        # of dicts of states that differ from the current ones. Returns the
+        # state each output would have in each of the scenarios.
+        results = self.graph.plan().evaluate(self.states, scenarios)
+
+        return {
+            rule.output_entity: [bool(mask >> bit & 1) for bit in range(len(scenarios))]
+            for rule, mask in results.items()
+        }
+
+    def command(self, rule):
+        if self.outbox is None:
+            rule.update(self)
+        else:
+            self.outbox.append((rule.output_entity, rule.last_state))
+
+    def grouped(self, callback, *args):
+        # Runs a callback, collecting the output commands it sends. They are
+        # then sent grouped by target state, as a single service call per
+        # group, so that e.g. all the lights of a room switch at the same
+        # time.
+        if self.outbox is not None:
+            return callback(*args)
+
+        self.outbox = []
+        try:
+            return callback(*args)
+        finally:
+            outbox = self.outbox
+            self.outbox = None
+            for state, entities in group_commands(outbox).items():
+                self.send_group(state, entities)
+
+    def send_group(self, state, entities):
+        # Groups go through the homeassistant domain's services, like
+        # turn_on and turn_off do, so they also work for domains without
+        # turn_on and turn_off services of their own (e.g. covers and locks)
+        if len(entities) == 1:
+            if state:
+                self.turn_on(entities[0])
+            else:
+                self.turn_off(entities[0])
+        else:
+            service = "turn_on" if state else "turn_off"
+            self.call_service(f"homeassistant/{service}", entity_id=entities)
+
+    def fetch_states(self, states):
+        states.load(self.get_state())
+        if self.stats is not None:
+            self.stats.state_fetches += 1
+
+    def publish_stats(self, kwargs):
+        summary = self.stats.summary(self.stats_top)
+        return self.set_state(
+            "sensor.reactive_stats",
+            state=summary["events"],
+            attributes={
+                "state_fetches": summary["state_fetches"],
+                "commands": summary["commands"],
+                "slowest_inputs": summary["inputs"],
+                "slowest_outputs": summary["outputs"],
+            },
+        )
+
+    def dump_stats(self, event_name, data, kwargs):
+        summary = json.dumps(self.stats.summary())
+        if self.stats_file:
+            with open(self.stats_file, "w") as f:
+                f.write(summary)
+        else:
+            self.log(summary)
+
+    @grouping_commands
     def output_becomes_available(self, entity, attribute, old, new, kwargs):
         self.log(f"output {entity} became available again")
-        self.output_rules[entity].update(self)
+        rule = self.output_rules.get(entity)
+        if rule is None or not self.needs_refresh(rule, new):
+            return
+
+        if self.recovery_limit is None:
+            self.scheduler.schedule(rule, force=True)
+            return
+
+        # When lots of devices come back at once (e.g. after a Zigbee
+        # coordinator restart), their refreshes are paced to not overload
+        # the network again. A device that flaps is only queued once.
+        self.recovering[entity] = None
+        self.schedule_recovery()
+
+    def needs_refresh(self, rule, state):
+        return state not in ("unavailable", "on" if rule.last_state else "off")
+
+    def current_state(self, entity):
+        return self.get_state(entity)
+
+    def schedule_recovery(self):
+        if self.recovery_timer is None:
+            self.recovery_timer = self.run_in(
+                self.recover_outputs, self.recovery_limit.wait(self.now()))
+
+    @grouping_commands
+    def recover_outputs(self, kwargs):
+        self.recovery_timer = None
+        now = self.now()
+
+        while self.recovering:
+            entity = next(iter(self.recovering))
+            rule = self.output_rules.get(entity)
+
+            # The device may have been set to the right state, or become
+            # unavailable again, while it was waiting in the queue
+            if rule is None or not self.needs_refresh(rule, self.current_state(entity)):
+                del self.recovering[entity]
+                continue
+
+            if not self.recovery_limit.take(now):
+                break
+
+            del self.recovering[entity]
+            self.scheduler.schedule(rule, force=True)
+
+        if self.recovering:
+            self.schedule_recovery()
+
+
+class AsyncOutputScheduler(OutputScheduler):
+    # Runs the scheduler's timer callbacks in the event loop, like the
+    # callbacks of AsyncReactive
+    async def drain(self, kwargs):
+        await self.hass.run_callback(super().drain, kwargs)
+
+    async def window_closed(self, kwargs):
+        await self.hass.run_callback(super().window_closed, kwargs)
+
+
+class AsyncReactive(Reactive):
+    # A variant of the app whose state change and sync callbacks run in
+    # AppDaemon's event loop. The (grouped) output commands resulting from a
+    # callback are sent concurrently (up to max_concurrent_commands at a
+    # time) instead of one after another, while the commands to the same
+    # output are still sent in order. Commands from initialize are sent as
+    # usual.
+    # All of the app's callbacks run in the event loop, so that its state is
+    # only ever used from one thread.
+    scheduler_class = AsyncOutputScheduler
+
+    def initialize(self):
+        self.command_slots = asyncio.Semaphore(self.args.get("max_concurrent_commands", 10))
+        self.output_locks = {}
+        self.outbox = None
+        self.prefetched = None
+        self.callback_time = None
+        super().initialize()
+
+    def fetch_states(self, states):
+        if self.prefetched is None:
+            super().fetch_states(states)
+            return
+
+        states.load(self.prefetched)
+        if self.stats is not None:
+            self.stats.state_fetches += 1
+
+    def now(self):
+        # In async callbacks, the time is read once before the callback runs
+        if self.callback_time is None:
+            return super().now()
+
+        return self.callback_time
+
+    def current_state(self, entity):
+        if self.prefetched is None:
+            return super().current_state(entity)
+
+        return (self.prefetched.get(entity) or {}).get("state")
+
+    async def run_callback(self, callback, *args, prefetch=False):
+        # The rules are evaluated synchronously, collecting the commands,
+        # which are then sent concurrently. The time and (if prefetch is set)
+        # the states are fetched before the callback runs, as it can't await.
+        now = await self.get_now_ts()
+        prefetched = await self.get_state() if prefetch else None
+
+        self.callback_time = now
+        self.prefetched = prefetched
+        self.outbox = []
+        try:
+            callback(*args)
+        finally:
+            outbox = self.outbox
+            self.outbox = None
+            self.prefetched = None
+            self.callback_time = None
+
+        await asyncio.gather(*(
+            self.send_group_async(state, entities)
+            for state, entities in group_commands(outbox).items()
+        ))
+
+    async def send_group_async(self, state, entities):
+        # The locks are taken in a fixed order, so groups sharing entities
+        # can't deadlock
+        async with contextlib.AsyncExitStack() as stack:
+            for entity in sorted(entities):
+                await stack.enter_async_context(
+                    self.output_locks.setdefault(entity, asyncio.Lock()))
+
+            async with self.command_slots:
+                if len(entities) > 1:
+                    service = "turn_on" if state else "turn_off"
+                    await self.call_service(f"homeassistant/{service}", entity_id=entities)
+                elif state:
+                    await self.turn_on(entities[0])
+                else:
+                    await self.turn_off(entities[0])
+
+    async def input_changed(self, entity, attribute, old, new, kwargs):
+        await self.run_callback(super().input_changed, entity, attribute, old, new, kwargs)
+
+    async def process_batch(self, kwargs):
+        await self.run_callback(super().process_batch, kwargs)
+
+    async def trigger_all(self, cb_args):
+        await self.run_callback(super().trigger_all, cb_args, prefetch=True)
+
+    async def advance_timers(self, kwargs):
+        await self.run_callback(super().advance_timers, kwargs)
+
+    async def resync_output(self, kwargs):
+        await self.run_callback(super().resync_output, kwargs)
+
+    async def output_becomes_available(self, entity, attribute, old, new, kwargs):
+        await self.run_callback(super().output_becomes_available, entity, attribute, old, new, kwargs)
+
+    async def recover_outputs(self, kwargs):
+        await self.run_callback(super().recover_outputs, kwargs, prefetch=True)
+
+    async def reconfigure_callback(self, kwargs):
+        await self.run_callback(super().reconfigure_callback, kwargs, prefetch=True)
+
+        # In the event loop, listen_state returns awaitables of the handles
+        for listeners in (self.input_listeners, self.output_listeners):
+            for entity, handle in list(listeners.items()):
+                if asyncio.isfuture(handle):
+                    listeners[entity] = await handle
+
+    async def save_snapshot_callback(self, kwargs):
+        await self.run_callback(super().save_snapshot_callback, kwargs)
+
+    async def flush_trace_callback(self, kwargs):
+        await self.run_callback(super().flush_trace_callback, kwargs)
+
+    async def publish_stats(self, kwargs):
+        await super().publish_stats(kwargs)
+
+    async def dump_stats(self, event_name, data, kwargs):
+        super().dump_stats(event_name, data, kwargs)
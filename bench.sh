@@ -0,0 +1 @@
+python3 tests/benchmark.py "$@"
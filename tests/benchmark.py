@@ -0,0 +1,135 @@
+# Benchmarks for parsing, indexing and event throughput with large,
+# synthetic rule sets. Runs on the mock hassapi and prints one JSON object
+# per scenario, so results from different versions can be compared.
+#
+# Usage: python3 tests/benchmark.py [--outputs 100 1000 5000] [--events 10000] [--output results.jsonl]
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.reactive import reactive  # noqa: E402
+from apps.reactive.reactive import Reactive  # noqa: E402
+
+
+def random_expression(rng, names, depth):
+    if depth == 0 or rng.random() < 0.3:
+        name = rng.choice(names)
+        r = rng.random()
+        if r < 0.1 and not name.startswith("alias_"):
+            return f"{name}=off"
+        if r < 0.2:
+            return f"!{name}"
+        return name
+
+    op = rng.choice(("&", "|"))
+    operands = [random_expression(rng, names, depth - 1)
+                for _ in range(rng.randint(2, 4))]
+    return "(" + f" {op} ".join(operands) + ")"
+
+
+def generate_config(outputs, inputs_per_output=8, aliases=50, depth=3, seed=0):
+    # Each room has its own sensors, and all rooms share a set of aliases
+    # (like is_dark or nightmode) built from house-wide sensors.
+    rng = random.Random(seed)
+    house = [f"binary_sensor.house_{i}" for i in range(aliases * 2)]
+
+    config = {
+        "aliases": {
+            f"alias_{i}": random_expression(rng, house, 2) for i in range(aliases)
+        },
+        "outputs": {},
+    }
+    alias_names = list(config["aliases"])
+
+    rooms = max(1, outputs // 10)
+    inputs = []
+    for i in range(outputs):
+        room = i % rooms
+        names = [f"binary_sensor.room_{room}_{j}" for j in range(inputs_per_output)]
+        inputs.extend(names)
+        config["outputs"][f"light.output_{i}"] = [
+            random_expression(rng, names + alias_names, depth),
+            rng.choice(names),
+        ]
+
+    return config, sorted(set(inputs) | set(house))
+
+
+def run_scenario(outputs, events, seed):
+    config, inputs = generate_config(outputs, seed=seed)
+    rng = random.Random(seed)
+    states = {i: rng.choice(("on", "off")) for i in inputs}
+
+    result = {"outputs": outputs, "inputs": len(inputs), "events": events}
+
+    # Startup, with and without a warm parse cache
+    reactive.parse_caches.clear()
+    gc.collect()
+    start = time.perf_counter()
+    app = Reactive(config, states=states)
+    result["initialize_s"] = time.perf_counter() - start
+    result["initialize_commands"] = len(app.mock_service_calls)
+
+    start = time.perf_counter()
+    app = Reactive(config, states=states)
+    result["initialize_cached_s"] = time.perf_counter() - start
+
+    result["graph_nodes"] = len(app.graph.nodes)
+
+    # Event throughput
+    app.mock_service_calls.clear()
+    changes = [(rng.choice(inputs), rng.choice(("on", "off"))) for _ in range(events)]
+
+    start = time.perf_counter()
+    for entity, state in changes:
+        app.mock_set_state(entity, state)
+    elapsed = time.perf_counter() - start
+
+    result["events_per_s"] = events / elapsed if elapsed else None
+    result["commands_per_event"] = len(app.mock_service_calls) / events
+
+    # Hourly sync
+    start = time.perf_counter()
+    app.mock_run_hourly()
+    result["periodic_sync_s"] = time.perf_counter() - start
+
+    # Memory used by a freshly initialized app
+    del app
+    reactive.parse_caches.clear()
+    gc.collect()
+    tracemalloc.start()
+    Reactive(config, states=states)
+    result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark reactive.py with synthetic rule sets")
+    parser.add_argument("--outputs", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the results to this file")
+    args = parser.parse_args()
+
+    for outputs in args.outputs:
+        line = json.dumps(run_scenario(outputs, args.events, args.seed))
+        print(line)
+
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
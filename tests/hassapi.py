@@ -1,13 +1,28 @@
 # Mock hassapi for unit testing
 
+import asyncio
+
 PRINT = False
 
 
 class Hass:
-    def __init__(self, args):
-        self.mock_states = {}
+    def __init__(self, args, states=None, attributes=None, now=0):
+        self.name = "reactive"
+        self.mock_states = dict(states or {})
+        self.mock_attributes = {e: dict(a) for e, a in (attributes or {}).items()}
         self.mock_listeners = {}
         self.mock_run_hourly = None
+        self.mock_get_state_calls = 0
+        self.mock_service_calls = []
+        self.mock_grouped_calls = []
+        self.mock_sensors = {}
+        self.mock_event_listeners = {}
+        self.mock_time = now
+        self.mock_timers = {}
+        self.mock_next_handle = 0
+        self.mock_loop = None
+        self.mock_in_flight = 0
+        self.mock_max_in_flight = 0
 
         self.args = args
         self.initialize()
@@ -17,27 +32,166 @@ class Hass:
             print("LOG:", msg)
 
     def run_hourly(self, callback, *args, **kwargs):
-        self.mock_run_hourly = lambda: callback(kwargs)
+        self.mock_run_hourly = lambda: self.mock_call(callback, kwargs)
+
+    def mock_in_loop(self):
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    def mock_result(self, value):
+        # Like AppDaemon, API calls made from async callbacks return awaitables
+        if not self.mock_in_loop():
+            return value
+
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(value)
+        return future
+
+    def mock_call(self, callback, *args):
+        # Call a callback, running it to completion if it is async
+        result = callback(*args)
+        if not asyncio.iscoroutine(result):
+            return
+
+        if self.mock_in_loop():
+            asyncio.get_running_loop().create_task(result)
+            return
+
+        if self.mock_loop is None:
+            self.mock_loop = asyncio.new_event_loop()
+
+        self.mock_loop.run_until_complete(result)
+        while True:
+            pending = asyncio.all_tasks(self.mock_loop)
+            if not pending:
+                break
+            self.mock_loop.run_until_complete(asyncio.gather(*pending))
+
+    def run_in(self, callback, delay, **kwargs):
+        self.mock_next_handle += 1
+        self.mock_timers[self.mock_next_handle] = (
+            self.mock_time + delay, callback, kwargs)
+        return self.mock_result(self.mock_next_handle)
+
+    def get_now_ts(self):
+        return self.mock_result(self.mock_time)
+
+    def cancel_timer(self, handle):
+        self.mock_timers.pop(handle, None)
+
+    def mock_advance(self, seconds):
+        # Move the clock forward, running timers in the order they are due
+        end = self.mock_time + seconds
+        while True:
+            due = [(when, handle) for handle, (when, _, _) in self.mock_timers.items() if when <= end]
+            if not due:
+                break
+
+            when, handle = min(due)
+            _, callback, kwargs = self.mock_timers.pop(handle)
+            self.mock_time = when
+            self.mock_call(callback, kwargs)
+
+        self.mock_time = end
+
+    def run_every(self, callback, start, interval, **kwargs):
+        def repeat(kwargs):
+            self.run_in(repeat, interval)
+            self.mock_call(callback, kwargs)
 
-    def listen_state(self, callback, states, old=None):
-        for s in states:
-            self.mock_listeners.setdefault(s, []).append((callback, old))
+        return self.run_in(repeat, interval)
 
-    def get_state(self, entity):
-        return self.mock_states.get(entity)
+    def listen_event(self, callback, event):
+        self.mock_event_listeners.setdefault(event, []).append(callback)
+
+    def fire_event(self, event, **data):
+        for callback in self.mock_event_listeners.get(event, ()):
+            self.mock_call(callback, event, data, None)
+
+    def set_state(self, entity, state=None, attributes=None):
+        # note: only used to publish sensors, so listeners aren't called
+        self.mock_sensors[entity] = {"state": state, "attributes": attributes}
+        return self.mock_result(None)
+
+    def listen_state(self, callback, entity, attribute=None, old=None):
+        self.mock_next_handle += 1
+        self.mock_listeners.setdefault(entity, []).append(
+            (self.mock_next_handle, callback, old, attribute))
+        return self.mock_result(self.mock_next_handle)
+
+    def cancel_listen_state(self, handle):
+        for entity, listeners in self.mock_listeners.items():
+            listeners[:] = [li for li in listeners if li[0] != handle]
+
+    def get_state(self, entity=None):
+        self.mock_get_state_calls += 1
+
+        if entity is None:
+            return self.mock_result({
+                e: {
+                    "entity_id": e,
+                    "state": self.mock_states.get(e),
+                    "attributes": dict(self.mock_attributes.get(e, {})),
+                }
+                for e in {**self.mock_states, **self.mock_attributes}
+            })
+
+        return self.mock_result(self.mock_states.get(entity))
 
     def turn_on(self, entity):
-        self.mock_set_state(entity, "on")
+        return self.mock_service("turn_on", entity, "on")
 
     def turn_off(self, entity):
-        self.mock_set_state(entity, "off")
+        return self.mock_service("turn_off", entity, "off")
+
+    def call_service(self, service, entity_id, **data):
+        # Only turn_on and turn_off of a list of entities are supported
+        domain, service = service.split("/")
+        new_state = {"turn_on": "on", "turn_off": "off"}[service]
+        self.mock_grouped_calls.append((f"{domain}/{service}", list(entity_id)))
+        return self.mock_service(service, entity_id, new_state)
+
+    def mock_service(self, service, entities, new_state):
+        # Records a service call as one call per entity
+        if isinstance(entities, str):
+            entities = [entities]
+
+        if not self.mock_in_loop():
+            for entity in entities:
+                self.mock_service_calls.append((service, entity))
+                self.mock_set_state(entity, new_state)
+            return
+
+        # From async code, the call is started right away (like
+        # AppDaemon does) but completes later
+        async def call():
+            self.mock_in_flight += 1
+            self.mock_max_in_flight = max(self.mock_max_in_flight, self.mock_in_flight)
+            await asyncio.sleep(0)
+            self.mock_in_flight -= 1
+            for entity in entities:
+                self.mock_service_calls.append((service, entity))
+                self.mock_set_state(entity, new_state)
+
+        return asyncio.get_running_loop().create_task(call())
 
     def mock_set_state(self, entity, new_state):
         old = self.mock_states.get(entity)
         self.mock_states[entity] = new_state
 
-        for listener, old_state in self.mock_listeners.get(entity, ()):
-            if old_state is None or old_state == old:
-                # note: attribute argument is unused in our coude
+        for _, listener, old_state, attribute in list(self.mock_listeners.get(entity, ())):
+            if attribute is None and (old_state is None or old_state == old):
                 # note: kwargs argument is unused in our code
-                listener(entity, None, old, new_state, None)
+                self.mock_call(listener, entity, None, old, new_state, None)
+
+    def mock_set_attribute(self, entity, attribute, value):
+        attributes = self.mock_attributes.setdefault(entity, {})
+        old = attributes.get(attribute)
+        attributes[attribute] = value
+
+        for _, listener, old_state, listened in list(self.mock_listeners.get(entity, ())):
+            if listened == attribute and (old_state is None or old_state == old):
+                self.mock_call(listener, entity, attribute, old, value, None)
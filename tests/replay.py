@@ -0,0 +1,119 @@
+# Replays a trace recorded with the trace setting against the app running on
+# the mock hassapi, as fast as possible, and prints the event throughput, the
+# number of commands and the most expensive rules as a JSON object. Useful
+# for profiling real traffic offline and comparing versions against it.
+# A trace appended to over several runs of the app is replayed one run at a
+# time, printing one JSON object per run.
+#
+# Usage: python3 tests/replay.py config.json trace.jsonl [--top 20] [--output results.jsonl]
+#
+# The config file holds the app's settings (the contents of its section in
+# apps.yaml) as JSON, or as YAML if PyYAML is installed.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.reactive import reactive  # noqa: E402
+from apps.reactive.reactive import Reactive  # noqa: E402
+
+# Settings that write files, which a replay should leave alone
+IGNORED_SETTINGS = ("trace", "snapshot", "parse_cache")
+
+
+def load_config(path):
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            return yaml.safe_load(f)
+
+        return json.load(f)
+
+
+def read_trace(path):
+    # Returns a (header, events) pair for each run of the app in the trace
+    runs = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if isinstance(record, dict):
+                runs.append((record, []))
+            elif not runs:
+                raise ValueError(f"{path} has no trace header")
+            else:
+                runs[-1][1].append(record)
+
+    if not runs:
+        raise ValueError(f"{path} has no trace header")
+
+    return runs
+
+
+def replay(config, header, events, app_class=Reactive, top=20):
+    config = {k: v for k, v in config.items() if k not in IGNORED_SETTINGS}
+    config["stats"] = {"sample": 1.0, "interval": 10 ** 9}
+
+    states = {}
+    attributes = {}
+    for name, state in header["states"].items():
+        entity, attribute = reactive.split_attribute(name)
+        if attribute is None:
+            states[entity] = state
+        elif state is not None:
+            attributes.setdefault(entity, {})[attribute] = state
+
+    app = app_class(config, states=states, attributes=attributes, now=header["time"])
+    app.stats = reactive.Stats(1.0)
+    app.mock_service_calls.clear()
+    app.mock_grouped_calls.clear()
+
+    start = time.perf_counter()
+    for now, entity, attribute, old, new in events:
+        if now > app.mock_time:
+            app.mock_advance(now - app.mock_time)
+
+        if attribute is None or attribute == "state":
+            app.mock_set_state(entity, new)
+        else:
+            app.mock_set_attribute(entity, attribute, new)
+    elapsed = time.perf_counter() - start
+
+    grouped = sum(len(entities) for _, entities in app.mock_grouped_calls)
+    summary = app.stats.summary(top)
+
+    return {
+        "events": len(events),
+        "elapsed_s": elapsed,
+        "events_per_s": len(events) / elapsed if elapsed else None,
+        "commands": summary["commands"],
+        "service_calls": len(app.mock_grouped_calls) + len(app.mock_service_calls) - grouped,
+        "rules": summary["outputs"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded trace against reactive.py")
+    parser.add_argument("config", help="the app's settings, as JSON or YAML")
+    parser.add_argument("trace", help="a trace recorded with the trace setting")
+    parser.add_argument("--top", type=int, default=20, help="number of rules to report")
+    parser.add_argument("--output", help="append the results to this file")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    for run, (header, events) in enumerate(read_trace(args.trace)):
+        line = json.dumps({"run": run, **replay(config, header, events, top=args.top)})
+        print(line)
+
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import operator
+import unittest
+from unittest import mock
+
+from apps.reactive.reactive import (
+    parse_inputs, Entity, Expression, UnaryExpression, OutputRule, RuleGraph, Node, Predicate, States,
+    ThresholdPredicate, TimerWheel)
+
+
+class TestRuleGraph(unittest.TestCase):
+    def make_graph(self, outputs, aliases={}, clock=None):
+        aliases = {name: parse_inputs(expr) for name, expr in aliases.items()}
+        rules = [OutputRule(out, inputs, aliases)
+                 for out, inputs in outputs.items()]
+
+        graph = RuleGraph() if clock is None else RuleGraph(TimerWheel(clock()), clock)
+        for rule in rules:
+            graph.add_rule(rule)
+
+        return graph, {r.output_entity: r for r in rules}
+
+    def test_refresh(self):
+        graph, rules = self.make_graph({
+            "light.a": ["motion & !dark", "switch"],
+            "light.b": ["cover=closed"],
+        })
+
+        graph.refresh({"motion": "on", "cover": "closed"})
+        self.assertTrue(rules["light.a"].node.value)
+        self.assertTrue(rules["light.b"].node.value)
+
+        graph.refresh({"motion": "on", "dark": "on"})
+        self.assertFalse(rules["light.a"].node.value)
+        self.assertFalse(rules["light.b"].node.value)
+
+    def test_update_returns_changed_rules(self):
+        graph, rules = self.make_graph({
+            "light.a": ["motion & dark"],
+            "light.b": ["motion"],
+        })
+
+        states = {"dark": "on"}
+        graph.refresh(states)
+
+        states["motion"] = "on"
+        self.assertCountEqual(
+            graph.update(states, ("motion",)), [rules["light.a"], rules["light.b"]])
+
+        states["dark"] = "off"
+        self.assertEqual(graph.update(states, ("dark",)), [rules["light.a"]])
+
+        states["dark"] = "unavailable"
+        self.assertEqual(graph.update(states, ("dark",)), [])
+
+    def test_shared_alias_is_recomputed_once(self):
+        graph, rules = self.make_graph(
+            {
+                "light.a": ["motion.a & is_dark"],
+                "light.b": ["motion.b & is_dark"],
+            },
+            aliases={"is_dark": "dark | cover=closed"},
+        )
+
+        states = {"motion.a": "on", "motion.b": "on"}
+        graph.refresh(states)
+
+        recompute = Node.recompute
+        with mock.patch.object(Node, "recompute", autospec=True, side_effect=recompute) as m:
+            states["dark"] = "on"
+            self.assertCountEqual(
+                graph.update(states, ("dark",)), [rules["light.a"], rules["light.b"]])
+
+            # the alias once and each of the rules' "&" and output nodes
+            self.assertEqual(m.call_count, 5)
+
+    def test_propagation_stops_when_value_is_unchanged(self):
+        graph, rules = self.make_graph(
+            {"light.a": ["motion & (dark | cover=closed)"]})
+
+        states = {"motion": "on", "dark": "on"}
+        graph.refresh(states)
+
+        recompute = Node.recompute
+        with mock.patch.object(Node, "recompute", autospec=True, side_effect=recompute) as m:
+            states["cover"] = "closed"
+            self.assertEqual(graph.update(states, ("cover",)), [])
+
+            # only the "|" node is recomputed: its value stays true
+            self.assertEqual(m.call_count, 1)
+
+    def test_only_predicates_of_old_and_new_state_are_updated(self):
+        graph, rules = self.make_graph({
+            f"light.{value}": [f"cover={value}"]
+            for value in ("open", "closed", "opening", "closing", "stopped")
+        })
+
+        states = {"cover": "closed"}
+        graph.refresh(states)
+
+        with mock.patch.object(Predicate, "recompute", autospec=True,
+                               side_effect=Predicate.recompute) as m:
+            states["cover"] = "opening"
+            self.assertCountEqual(graph.update(states, ("cover",)),
+                                  [rules["light.closed"], rules["light.opening"]])
+            self.assertCountEqual([c.args[0].expected for c in m.call_args_list],
+                                  ["closed", "opening"])
+
+            m.reset_mock()
+            states["cover"] = "unavailable"
+            self.assertEqual(graph.update(states, ("cover",)), [rules["light.opening"]])
+            self.assertEqual(m.call_count, 1)
+
+    def test_only_crossed_thresholds_are_updated(self):
+        graph, rules = self.make_graph({
+            "light.a": ["lux < 10"],
+            "light.b": ["lux <= 50"],
+            "light.c": ["lux > 50 & lux < 200"],
+            "light.d": ["lux >= 1000"],
+        })
+
+        states = {"lux": "5"}
+        graph.refresh(states)
+        self.assertEqual([r.node.value for r in rules.values()], [True, True, False, False])
+
+        with mock.patch.object(ThresholdPredicate, "recompute", autospec=True,
+                               side_effect=ThresholdPredicate.recompute) as m:
+            states["lux"] = "8.5"
+            self.assertEqual(graph.update(states, ("lux",)), [])
+            self.assertEqual(m.call_count, 0)
+
+            states["lux"] = "50"
+            self.assertEqual(graph.update(states, ("lux",)), [rules["light.a"]])
+            self.assertEqual(m.call_count, 3)
+
+            m.reset_mock()
+            states["lux"] = "120"
+            self.assertCountEqual(graph.update(states, ("lux",)),
+                                  [rules["light.b"], rules["light.c"]])
+            self.assertEqual(m.call_count, 2)
+
+            m.reset_mock()
+            states["lux"] = "unavailable"
+            self.assertEqual(graph.update(states, ("lux",)), [rules["light.c"]])
+            self.assertEqual(m.call_count, 5)
+
+        self.assertEqual(
+            graph.plan().evaluate(states, [{"lux": "5"}, {"lux": "2000"}]),
+            {rules["light.a"]: 0b01, rules["light.b"]: 0b01,
+             rules["light.c"]: 0b00, rules["light.d"]: 0b10})
+
+    def test_attributes(self):
+        states = States(None)
+        states.load({"light.a": {"state": "on", "attributes": {"brightness": 120}}})
+        self.assertEqual(states.get("light.a.brightness"), "120")
+        self.assertIsNone(states.get("light.a.color"))
+        self.assertIsNone(states.get("light.b.brightness"))
+
+        states.set_attribute("light.a", "brightness", 80)
+        self.assertEqual(states.get("light.a.brightness"), "80")
+
+    def test_states_are_interned(self):
+        states = States(None)
+        states.load({"light": {"state": "".join(["o", "n"])}})
+        states.set("cover", "".join(["clo", "sed"]))
+
+        self.assertIs(states.get("cover"), "closed")
+        self.assertIs(states.get("light"), "on")
+
+    def test_time_conditions(self):
+        now = [0]
+        graph, rules = self.make_graph({
+            "light.a": ["within:10 motion"],
+            "light.b": ["for:5 door=open"],
+            "light.c": ["for:5 motion & !door=open"],
+        }, clock=lambda: now[0])
+
+        states = {"motion": "on", "door": "closed"}
+        graph.refresh(states)
+        self.assertTrue(rules["light.a"].node.value)
+        self.assertFalse(rules["light.c"].node.value)
+
+        def advance(seconds):
+            now[0] += seconds
+            return graph.expire(states, graph.timers.advance(now[0]))
+
+        self.assertEqual(advance(5), [rules["light.c"]])
+
+        now[0] += 1
+        states.update(motion="off", door="open")
+        self.assertEqual(graph.update(states, ("motion", "door")), [rules["light.c"]])
+        self.assertEqual(len(graph.timers), 2)
+
+        self.assertEqual(advance(5), [rules["light.b"]])
+        self.assertEqual(advance(4), [])
+        self.assertEqual(advance(1), [rules["light.a"]])
+        self.assertEqual(len(graph.timers), 0)
+
+        # A scenario changing the state counts as a state change right now
+        self.assertEqual(
+            graph.plan().evaluate(states, [{"motion": "on"}, {"door": "closed"}]),
+            {rules["light.a"]: 0b01, rules["light.b"]: 0b01, rules["light.c"]: 0b00})
+
+    def test_timer_wheel(self):
+        wheel = TimerWheel(0, resolution=1, size=8)
+        wheel.schedule("a", 2.5)
+        wheel.schedule("b", 20)
+        wheel.schedule("c", 3)
+        wheel.cancel("c")
+
+        self.assertEqual(wheel.advance(2), [])
+        self.assertEqual(wheel.advance(3), ["a"])
+        self.assertEqual(wheel.advance(12), [])
+        self.assertEqual(len(wheel), 1)
+
+        wheel.schedule("c", 1)
+        self.assertEqual(wheel.advance(13), ["c"])
+        self.assertEqual(wheel.advance(100), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_identical_subexpressions_are_shared(self):
+        graph, rules = self.make_graph({
+            "light.a": ["motion.a & (dark | cover=closed)"],
+            "light.b": ["(cover=closed | dark) & motion.b", "switch"],
+        })
+
+        shared = rules["light.a"].node.children[0].children[1]
+        self.assertIs(rules["light.b"].node.children[0].children[0], shared)
+
+        # predicates: motion.a, motion.b, dark, cover=closed, switch
+        # inner nodes: the shared "|" and the two "&"
+        # plus one output node per rule
+        self.assertEqual(len(graph.nodes), 5 + 3 + 2)
+
+    def test_value_checks_are_part_of_the_identity(self):
+        graph, rules = self.make_graph({
+            "light.a": ["cover=closed & dark"],
+            "light.b": ["cover=open & dark"],
+            "light.c": ["cover & dark"],
+            "light.d": ["cover=on & dark"],
+        })
+
+        a = rules["light.a"].node.children[0]
+        b = rules["light.b"].node.children[0]
+        self.assertIsNot(a, b)
+        self.assertIsNot(b, rules["light.c"].node.children[0])
+        self.assertIs(rules["light.c"].node.children[0], rules["light.d"].node.children[0])
+
+    def test_bulk_plan(self):
+        graph, rules = self.make_graph(
+            {
+                "light.a": ["motion & !is_dark", "switch"],
+                "light.b": ["cover=closed | !(motion & dark)"],
+            },
+            aliases={"is_dark": "dark | cover=closed"},
+        )
+
+        states = {"motion": "on"}
+        scenarios = [{}, {"dark": "on"}, {"switch": "on", "dark": "on"},
+                     {"cover": "closed", "motion": "off"}]
+        results = graph.plan().evaluate(states, scenarios)
+
+        for bit, scenario in enumerate(scenarios):
+            graph.refresh(dict(states, **scenario))
+            for rule in rules.values():
+                self.assertEqual(
+                    bool(results[rule] >> bit & 1), rule.node.value, (rule, scenario))
+
+    def test_bulk_plan_generic_operators(self):
+        rule = OutputRule("light.a", [])
+        rule.input_states = [
+            Expression(operator.xor, Entity("a"), UnaryExpression(operator.not_, Entity("b")))]
+
+        graph = RuleGraph()
+        graph.add_rule(rule)
+
+        results = graph.plan().evaluate({}, [{}, {"a": "on"}, {"b": "on"}, {"a": "on", "b": "on"}])
+        self.assertEqual(results[rule], 0b1001)
@@ -1,9 +1,21 @@
+import itertools
+import random
 import unittest
 
-from apps.reactive.reactive import parse_inputs, Expression, UnaryExpression, Entity
+from apps.reactive.reactive import (
+    parse_inputs, simplify, Expression, ExpressionError, UnaryExpression, Entity, TimedEntity,
+    Comparison, OutputRule, RuleGraph)
 from operator import not_, and_, or_
 
 
+def evaluate(expr, states):
+    # Expressions are only evaluated by the rule graph
+    graph = RuleGraph()
+    node = graph.convert(expr)
+    graph.refresh(states)
+    return node.value
+
+
 class TestInputExpressionParser(unittest.TestCase):
     def test_basic_operators(self):
         expr = parse_inputs("switch.a & sensor.b | switch.c")
@@ -11,9 +23,27 @@ class TestInputExpressionParser(unittest.TestCase):
             repr(expr),
             repr(
                 Expression(
-                    and_,
+                    or_,
+                    Expression(and_, Entity("switch.a"), Entity("sensor.b")),
+                    Entity("switch.c"),
+                )
+            ),
+        )
+
+    def test_precedence(self):
+        expr = parse_inputs("switch.a | sensor.b & switch.c | !sensor.d & switch.e")
+        self.assertEqual(
+            repr(expr),
+            repr(
+                Expression(
+                    or_,
                     Entity("switch.a"),
-                    Expression(or_, Entity("sensor.b"), Entity("switch.c")),
+                    Expression(and_, Entity("sensor.b"), Entity("switch.c")),
+                    Expression(
+                        and_,
+                        UnaryExpression(not_, Entity("sensor.d")),
+                        Entity("switch.e"),
+                    ),
                 )
             ),
         )
@@ -26,15 +56,19 @@ class TestInputExpressionParser(unittest.TestCase):
                 Expression(
                     and_,
                     Entity("switch.a"),
-                    Expression(
-                        and_,
-                        UnaryExpression(not_, Entity("sensor.b")),
-                        Entity("sensor.c"),
-                    )
+                    UnaryExpression(not_, Entity("sensor.b")),
+                    Entity("sensor.c"),
                 )
             )
         )
 
+    def test_double_negation(self):
+        expr = parse_inputs("!!switch.a")
+        self.assertEqual(
+            repr(expr),
+            repr(UnaryExpression(not_, UnaryExpression(not_, Entity("switch.a"))))
+        )
+
     def test_whitespace(self):
         expr = parse_inputs(
             """switch.a&
@@ -47,9 +81,9 @@ class TestInputExpressionParser(unittest.TestCase):
             repr(expr),
             repr(
                 Expression(
-                    and_,
-                    Entity("switch.a"),
-                    Expression(or_, Entity("sensor.b"), Entity("switch.c")),
+                    or_,
+                    Expression(and_, Entity("switch.a"), Entity("sensor.b")),
+                    Entity("switch.c"),
                 )
             ),
         )
@@ -78,37 +112,116 @@ class TestInputExpressionParser(unittest.TestCase):
                     and_,
                     Entity("switch.a"),
                     Expression(
-                        and_,
+                        or_,
+                        Entity("sensor.b"),
                         Expression(
-                            or_,
-                            Entity("sensor.b"),
-                            Expression(
-                                and_,
-                                Entity("switch.c"),
-                                Entity("sensor.c")
-                            ),
+                            and_,
+                            Entity("switch.c"),
+                            Entity("sensor.c")
                         ),
+                    ),
+                    Expression(
+                        or_,
+                        Entity("sensor.d"),
+                        Entity("sensor.e")
+                    ),
+                    UnaryExpression(
+                        not_,
                         Expression(
                             and_,
-                            Expression(
-                                or_,
-                                Entity("sensor.d"),
-                                Entity("sensor.e")
-                            ),
-                            UnaryExpression(
-                                not_,
-                                Expression(
-                                    and_,
-                                    Entity('sensor.f'),
-                                    Entity('sensor.g')
-                                )
-                            )
+                            Entity('sensor.f'),
+                            Entity('sensor.g')
                         )
                     )
                 )
             ),
         )
 
+    def test_parenthesized_chains_are_flattened(self):
+        expr = parse_inputs("(switch.a | switch.b) | (switch.c | (switch.d))")
+        self.assertEqual(
+            repr(expr),
+            repr(
+                Expression(
+                    or_,
+                    Entity("switch.a"),
+                    Entity("switch.b"),
+                    Entity("switch.c"),
+                    Entity("switch.d"),
+                )
+            ),
+        )
+
+    def test_long_expression(self):
+        sensors = [f"binary_sensor.motion_{i}" for i in range(5000)]
+        expr = parse_inputs(" | ".join(sensors))
+
+        self.assertEqual(len(expr.operands), len(sensors))
+        self.assertTrue(evaluate(expr, {"binary_sensor.motion_4999": "on"}))
+
+    def test_errors(self):
+        for inputs in ("", "switch.a &", "& switch.a", "switch.a (switch.b)",
+                       "(switch.a", "switch.a)", "switch.a & ()", "!"):
+            with self.assertRaises(ExpressionError, msg=inputs):
+                parse_inputs(inputs)
+
+    def test_time_conditions(self):
+        expr = parse_inputs("for:5m binary_sensor.door=open & !within:30 binary_sensor.motion")
+        self.assertEqual(
+            repr(expr),
+            repr(
+                Expression(
+                    and_,
+                    TimedEntity("binary_sensor.door", "open", "for", 300),
+                    UnaryExpression(not_, TimedEntity("binary_sensor.motion", None, "within", 30)),
+                )
+            ),
+        )
+        self.assertEqual(parse_inputs("within:1.5h  switch.a").seconds, 5400)
+
+        with self.assertRaises(ExpressionError):
+            parse_inputs("for:5m within:5m switch.a")
+
+    def test_time_condition_aliases(self):
+        aliases = {"door": Entity("binary_sensor.door"), "dark": parse_inputs("a | b")}
+        self.assertEqual(repr(parse_inputs("for:10s door=open", aliases)),
+                         "for:10 binary_sensor.door='open'")
+
+        with self.assertRaises(ExpressionError):
+            parse_inputs("for:10s dark", aliases)
+
+        aliases = {"recent_motion": parse_inputs("within:5m binary_sensor.motion")}
+        with self.assertRaises(ExpressionError):
+            parse_inputs("recent_motion=off", aliases)
+
+    def test_comparisons(self):
+        expr = parse_inputs("sensor.lux < 50 & sensor.temperature>=21.5 | light.a.brightness>100")
+        self.assertEqual(
+            repr(expr),
+            repr(
+                Expression(
+                    or_,
+                    Expression(
+                        and_,
+                        Comparison("sensor.lux", "<", 50),
+                        Comparison("sensor.temperature", ">=", 21.5),
+                    ),
+                    Comparison("light.a.brightness", ">", 100),
+                )
+            ),
+        )
+
+        self.assertTrue(evaluate(expr, {"sensor.lux": "10", "sensor.temperature": "21.5"}))
+        self.assertFalse(evaluate(expr, {"sensor.lux": "unavailable", "sensor.temperature": "22"}))
+        self.assertTrue(evaluate(expr, {"light.a.brightness": "255"}))
+
+        for inputs in ("sensor.lux < dark", "sensor.lux >", "for:5m sensor.lux < 5"):
+            with self.assertRaises(ExpressionError, msg=inputs):
+                parse_inputs(inputs)
+
+        self.assertEqual(repr(parse_inputs("lux < 5", {"lux": Entity("sensor.lux")})),
+                         "sensor.lux<5")
+
     def test_negated_parens(self):
         expr = parse_inputs(
             "!(sensor.a & sensor.b) & sensor.c"
@@ -130,3 +243,127 @@ class TestInputExpressionParser(unittest.TestCase):
                 )
             )
         )
+
+
+class TestLegacyPrecedence(unittest.TestCase):
+    def test_right_associative(self):
+        expr = parse_inputs("switch.a & sensor.b | switch.c", legacy=True)
+        self.assertEqual(
+            repr(expr),
+            repr(
+                Expression(
+                    and_,
+                    Entity("switch.a"),
+                    Expression(or_, Entity("sensor.b"), Entity("switch.c")),
+                )
+            ),
+        )
+
+    def test_mixed_chain(self):
+        expr = parse_inputs(
+            "switch.a | !sensor.b & switch.c & (sensor.d | sensor.e) | switch.f", legacy=True)
+        self.assertEqual(
+            repr(expr),
+            repr(
+                Expression(
+                    or_,
+                    Entity("switch.a"),
+                    Expression(
+                        and_,
+                        UnaryExpression(not_, Entity("sensor.b")),
+                        Entity("switch.c"),
+                        Expression(
+                            or_,
+                            Entity("sensor.d"),
+                            Entity("sensor.e"),
+                            Entity("switch.f"),
+                        ),
+                    ),
+                )
+            ),
+        )
+
+
+class TestSimplify(unittest.TestCase):
+    def assertSimplifies(self, inputs, expected):
+        self.assertEqual(repr(simplify(parse_inputs(inputs))), repr(parse_inputs(expected)))
+
+    def test_double_negation(self):
+        self.assertSimplifies("!!switch.a & !!!switch.b", "switch.a & !switch.b")
+
+    def test_idempotence(self):
+        self.assertSimplifies("switch.a | switch.b | switch.a", "switch.a | switch.b")
+        self.assertSimplifies("switch.a & switch.b | switch.b & switch.a", "switch.a & switch.b")
+
+    def test_absorption(self):
+        self.assertSimplifies("switch.a | switch.a & switch.b", "switch.a")
+        self.assertSimplifies("switch.a & (switch.a | switch.b)", "switch.a")
+        self.assertSimplifies(
+            "switch.a & switch.b | switch.c | switch.b & switch.a & switch.d",
+            "switch.a & switch.b | switch.c")
+
+    def test_factoring(self):
+        self.assertSimplifies(
+            "switch.a & switch.b | switch.c & switch.a",
+            "switch.a & (switch.b | switch.c)")
+
+    def test_constants(self):
+        self.assertIs(simplify(parse_inputs("switch.a & !switch.a")), False)
+        self.assertIs(simplify(parse_inputs("switch.a | !switch.a")), True)
+        self.assertIs(simplify(parse_inputs("cover=open & cover=closed")), False)
+        self.assertIs(simplify(parse_inputs("!(switch.a & !switch.a)")), True)
+        self.assertSimplifies("(switch.a | !switch.a) & switch.b", "switch.b")
+        self.assertSimplifies("switch.a & switch.a=on", "switch.a")
+
+    def test_time_conditions(self):
+        self.assertSimplifies("within:5m switch.a & switch.a=off", "within:5m switch.a & switch.a=off")
+        self.assertSimplifies("within:5m switch.a | within:300 switch.a", "within:5m switch.a")
+        self.assertSimplifies("switch.a | for:5m switch.a", "switch.a | for:5m switch.a")
+
+    def test_unchanged_expressions_are_kept(self):
+        expr = parse_inputs("switch.a & !(switch.b | switch.c)")
+        self.assertIs(simplify(expr), expr)
+
+    def test_shared_expressions_are_not_modified(self):
+        alias = parse_inputs("switch.a | switch.b")
+        expr = parse_inputs("is_on & switch.a", {"is_on": alias})
+
+        self.assertEqual(repr(simplify(expr)), "switch.a")
+        self.assertEqual(repr(alias), "(switch.a or_ switch.b)")
+
+    def test_rule_alternatives(self):
+        rule = OutputRule("light.a", ["switch.a & switch.b", "switch.a", "switch.c & switch.d"])
+        self.assertEqual(repr(rule.input_states), "[switch.a, (switch.c and_ switch.d)]")
+        self.assertIsNone(rule.constant)
+
+        rule = OutputRule("light.a", ["switch.a & switch.b", "switch.c & switch.a"])
+        self.assertEqual(repr(rule.input_states), "[(switch.a and_ (switch.b or_ switch.c))]")
+        self.assertEqual(rule.inputs, {"switch.a", "switch.b", "switch.c"})
+
+        rule = OutputRule("light.a", ["switch.a & switch.b", "switch.a"])
+        self.assertEqual(rule.inputs, {"switch.a"})
+
+        rule = OutputRule("light.a", ["switch.a", "!switch.a"])
+        self.assertIs(rule.constant, True)
+        self.assertEqual(len(rule.input_states), 2)
+
+    def test_equivalent_to_original(self):
+        rng = random.Random(0)
+        names = ["a", "b", "c", "d=x"]
+
+        def random_expression(depth):
+            if depth == 0 or rng.random() < 0.3:
+                return rng.choice(["", "!"]) + rng.choice(names)
+            op = rng.choice((" & ", " | "))
+            return "(" + op.join(random_expression(depth - 1)
+                                 for _ in range(rng.randint(2, 3))) + ")"
+
+        for _ in range(200):
+            expr = parse_inputs(random_expression(3))
+            simplified = simplify(expr)
+
+            for a, b, c, d in itertools.product(("on", "off"), ("on", "off"),
+                                                ("on", "off"), ("x", "y")):
+                states = {"a": a, "b": b, "c": c, "d": d}
+                result = simplified if isinstance(simplified, bool) else evaluate(simplified, states)
+                self.assertEqual(result, evaluate(expr, states), (expr, simplified, states))
@@ -1,6 +1,13 @@
+import asyncio
+import json
+import os
+import tempfile
 import unittest
+from unittest import mock
 
-from apps.reactive.reactive import Reactive
+import replay
+from apps.reactive import reactive
+from apps.reactive.reactive import Reactive, AsyncReactive
 
 
 class TestReactiveApp(unittest.TestCase):
@@ -85,6 +92,13 @@ class TestReactiveApp(unittest.TestCase):
                 "binary_sensor.lightswitch": "off", "light.test": "off"}
         )
 
+    def test_output_without_inputs(self):
+        app = Reactive({"outputs": {"light.a": [], "light.b": ["switch.b"]}})
+        self.assertEqual(app.mock_states, {"light.a": "off", "light.b": "off"})
+
+        app.turn_on("switch.b")
+        self.assertEqual(app.mock_states, {"light.a": "off", "light.b": "on", "switch.b": "on"})
+
     def test_output_becomes_available(self):
         app = Reactive(
             {"outputs": {"light.test": ["binary_sensor.lightswitch"]}})
@@ -108,6 +122,49 @@ class TestReactiveApp(unittest.TestCase):
                 "binary_sensor.lightswitch": "on", "light.test": "on"}
         )
 
+    def test_output_becomes_available_in_right_state(self):
+        app = Reactive(
+            {"outputs": {"light.test": ["binary_sensor.lightswitch"]}})
+        app.mock_set_state("binary_sensor.lightswitch", "on")
+        app.mock_service_calls.clear()
+
+        app.mock_set_state("light.test", "unavailable")
+        app.mock_set_state("light.test", "on")
+        self.assertEqual(app.mock_service_calls, [])
+
+    def test_availability_rate(self):
+        outputs = {f"light.test{i}": ["binary_sensor.lightswitch"] for i in range(6)}
+        app = Reactive({"availability_rate": 2, "outputs": outputs})
+        app.mock_set_state("binary_sensor.lightswitch", "on")
+        app.mock_advance(10)
+        app.mock_service_calls.clear()
+
+        app.log("### All lights come back at once after a power outage")
+        for output in outputs:
+            app.mock_set_state(output, "unavailable")
+        for output in outputs:
+            app.mock_set_state(output, "off")
+
+        app.log("### A flapping light is only queued once")
+        app.mock_set_state("light.test0", "unavailable")
+        app.mock_set_state("light.test0", "off")
+
+        app.log("### One light is turned on manually, one is lost again")
+        app.mock_set_state("light.test4", "on")
+        app.mock_set_state("light.test5", "unavailable")
+
+        app.mock_advance(0)
+        self.assertEqual(app.mock_service_calls, [
+            ("turn_on", "light.test0"), ("turn_on", "light.test1")])
+
+        app.mock_advance(1)
+        self.assertEqual(len(app.mock_service_calls), 4)
+        app.mock_advance(1)
+        self.assertEqual(len(app.mock_service_calls), 4)
+        self.assertEqual(app.mock_states["light.test5"], "unavailable")
+        self.assertTrue(all(
+            app.mock_states[f"light.test{i}"] == "on" for i in range(5)))
+
     def test_parenthesis(self):
         app = Reactive(
             {
@@ -370,3 +427,800 @@ class TestReactiveApp(unittest.TestCase):
             app.mock_states, {
                 "binary_sensor.switch": "on", "light.test": "off"}
         )
+
+    def test_state_mirror(self):
+        app = Reactive(
+            {"outputs": {"light.test": ["binary_sensor.motion & binary_sensor.dark"]}},
+            states={"binary_sensor.dark": "on"},
+        )
+
+        app.log("### Initial states are fetched in a single bulk call")
+        self.assertEqual(app.mock_get_state_calls, 1)
+
+        app.turn_on("binary_sensor.motion")
+        self.assertEqual(app.mock_states["light.test"], "on")
+        self.assertEqual(app.mock_get_state_calls, 1)
+
+        app.log("### A missed state change is picked up by the periodic sync")
+        app.mock_states["binary_sensor.dark"] = "off"
+        app.mock_run_hourly()
+        self.assertEqual(app.mock_states["light.test"], "off")
+        self.assertEqual(app.mock_get_state_calls, 2)
+
+    def test_debounce(self):
+        app = Reactive(
+            {
+                "debounce": 5,
+                "outputs": {
+                    "light.test": ["binary_sensor.motion"],
+                    "light.other": {"inputs": ["binary_sensor.motion"], "debounce": 0},
+                },
+            }
+        )
+        app.mock_advance(5)
+        app.mock_service_calls.clear()
+
+        app.log("### The first change is sent immediately")
+        app.mock_set_state("binary_sensor.motion", "on")
+        self.assertEqual(app.mock_states["light.test"], "on")
+
+        app.log("### Changes within the window are held back")
+        app.mock_set_state("binary_sensor.motion", "off")
+        app.mock_set_state("binary_sensor.motion", "on")
+        app.mock_set_state("binary_sensor.motion", "off")
+        app.mock_advance(4)
+        self.assertEqual(app.mock_states["light.test"], "on")
+
+        app.log("### ...and only the final state is sent when the window closes")
+        app.mock_advance(1)
+        self.assertEqual(app.mock_states["light.test"], "off")
+        self.assertEqual(
+            [c for c in app.mock_service_calls if c[1] == "light.test"],
+            [("turn_on", "light.test"), ("turn_off", "light.test")],
+        )
+
+        app.log("### Outputs without a window get every change")
+        self.assertEqual(
+            [c for c in app.mock_service_calls if c[1] == "light.other"],
+            [
+                ("turn_on", "light.other"),
+                ("turn_off", "light.other"),
+                ("turn_on", "light.other"),
+                ("turn_off", "light.other"),
+            ],
+        )
+
+    def test_debounce_drops_unchanged_state(self):
+        app = Reactive(
+            {"outputs": {"light.test": {"inputs": ["binary_sensor.motion"], "debounce": 5}}}
+        )
+        app.mock_advance(5)
+        app.mock_set_state("binary_sensor.motion", "on")
+        app.mock_set_state("binary_sensor.motion", "off")
+        app.mock_set_state("binary_sensor.motion", "on")
+        app.mock_service_calls.clear()
+
+        app.log("### The light is already on, so no command is sent")
+        app.mock_advance(5)
+        self.assertEqual(app.mock_service_calls, [])
+
+    def test_periodic_sync_only_commands_drifted_outputs(self):
+        app = Reactive(
+            {
+                "resync_spread": 60,
+                "outputs": {
+                    "light.a": ["binary_sensor.a"],
+                    "light.b": ["binary_sensor.b"],
+                    "light.c": ["binary_sensor.c"],
+                    "light.d": ["binary_sensor.d"],
+                },
+            }
+        )
+
+        app.mock_states["light.b"] = "on"
+        app.mock_states["light.c"] = "on"
+        app.mock_states["light.d"] = "unavailable"
+        app.mock_service_calls.clear()
+
+        app.log("### Only the first drifted output is corrected right away")
+        app.mock_run_hourly()
+        self.assertEqual(app.mock_service_calls, [("turn_off", "light.b")])
+
+        app.log("### ...the rest are spread out over the configured period")
+        app.mock_advance(30)
+        self.assertEqual(
+            app.mock_service_calls,
+            [("turn_off", "light.b"), ("turn_off", "light.c")]
+        )
+        self.assertEqual(app.mock_states["light.d"], "unavailable")
+
+        app.log("### Nothing is sent when nothing has drifted")
+        app.mock_service_calls.clear()
+        app.mock_run_hourly()
+        app.mock_advance(60)
+        self.assertEqual(app.mock_service_calls, [])
+
+    def test_batching(self):
+        app = Reactive(
+            {
+                "batch": 0.5,
+                "outputs": {
+                    "light.a": ["binary_sensor.a & binary_sensor.b"],
+                    "light.b": ["binary_sensor.a | binary_sensor.b"],
+                },
+            }
+        )
+        app.mock_service_calls.clear()
+
+        app.log("### Changes are held until the end of the batch")
+        app.mock_set_state("binary_sensor.a", "on")
+        app.mock_set_state("binary_sensor.b", "on")
+        app.mock_set_state("binary_sensor.a", "off")
+        app.mock_set_state("binary_sensor.a", "on")
+        self.assertEqual(app.mock_service_calls, [])
+
+        app.log("### ...and then evaluated once against the final states")
+        app.mock_advance(0.5)
+        self.assertCountEqual(
+            app.mock_service_calls,
+            [("turn_on", "light.a"), ("turn_on", "light.b")]
+        )
+
+        app.log("### A new batch starts with the next change")
+        app.mock_set_state("binary_sensor.b", "off")
+        app.mock_advance(0.5)
+        self.assertEqual(app.mock_states["light.a"], "off")
+        self.assertEqual(app.mock_states["light.b"], "on")
+
+    def test_legacy_precedence(self):
+        config = {
+            "aliases": {"either": "binary_sensor.a & binary_sensor.b | binary_sensor.c"},
+            "outputs": {"light.test": ["either"]},
+        }
+
+        app = Reactive(config, states={"binary_sensor.c": "on"})
+        self.assertEqual(app.mock_states["light.test"], "on")
+
+        app = Reactive(dict(config, legacy_precedence=True),
+                       states={"binary_sensor.c": "on"})
+        self.assertEqual(app.mock_states["light.test"], "off")
+
+    def test_parse_cache(self):
+        config = {
+            "aliases": {"is_dark": "binary_sensor.dark | cover=closed"},
+            "outputs": {
+                "light.a": ["binary_sensor.motion_a & is_dark"],
+                "light.b": ["binary_sensor.motion_b & is_dark", "switch.b"],
+            },
+        }
+        reactive.parse_caches.clear()
+        app = Reactive(config)
+
+        with mock.patch.object(reactive, "parse_inputs", wraps=reactive.parse_inputs) as parse:
+            app.log("### Only the changed rule is parsed on reload")
+            config["outputs"]["light.b"] = ["binary_sensor.motion_b", "switch.b"]
+            app = Reactive(config)
+            self.assertEqual(
+                [c.args[0] for c in parse.call_args_list], ["binary_sensor.motion_b"])
+
+            app.log("### Changing an alias reparses it, and re-resolves the rules using it")
+            parse.reset_mock()
+            config["aliases"]["is_dark"] = "binary_sensor.dark"
+            app = Reactive(config)
+            self.assertEqual(
+                [c.args[0] for c in parse.call_args_list], ["binary_sensor.dark"])
+
+            app.mock_set_state("binary_sensor.motion_a", "on")
+            app.mock_set_state("cover", "closed")
+            self.assertEqual(app.mock_states["light.a"], "off")
+            app.mock_set_state("binary_sensor.dark", "on")
+            self.assertEqual(app.mock_states["light.a"], "on")
+
+    def test_parse_cache_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {
+                "parse_cache": os.path.join(tmp, "cache"),
+                "outputs": {"light.a": ["binary_sensor.motion_a"]},
+            }
+            reactive.parse_caches.clear()
+            Reactive(config)
+
+            reactive.parse_caches.clear()
+            with mock.patch.object(reactive, "parse_inputs") as parse:
+                app = Reactive(config)
+                parse.assert_not_called()
+
+            app.mock_set_state("binary_sensor.motion_a", "on")
+            self.assertEqual(app.mock_states["light.a"], "on")
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {
+                "snapshot": os.path.join(tmp, "snapshot.json"),
+                "outputs": {
+                    "light.a": ["binary_sensor.motion_a"],
+                    "light.b": ["binary_sensor.motion_b"],
+                    "light.c": ["!binary_sensor.motion_b"],
+                    "switch.fan": ["for:10m binary_sensor.door=open"],
+                },
+            }
+            app = Reactive(config, states={"binary_sensor.door": "closed"})
+            app.mock_set_state("binary_sensor.motion_a", "on")
+            app.mock_set_state("binary_sensor.door", "open")
+            app.mock_advance(60)
+
+            app.log("### AppDaemon is restarted, and motion_b changed meanwhile")
+            app.terminate()
+            states = dict(app.mock_states, **{"binary_sensor.motion_b": "on"})
+            app = Reactive(config, states=states, now=app.mock_time + 30)
+            self.assertCountEqual(app.mock_service_calls, [
+                ("turn_on", "light.b"), ("turn_off", "light.c")])
+
+            app.log("### The time condition kept its progress")
+            app.mock_advance(500)
+            self.assertEqual(app.mock_states["switch.fan"], "off")
+            app.mock_advance(10)
+            self.assertEqual(app.mock_states["switch.fan"], "on")
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.jsonl")
+            config = {
+                "trace": {"file": path, "buffer": 2},
+                "outputs": {
+                    "light.a": ["binary_sensor.motion & sensor.lux < 20"],
+                    "light.b": ["within:1m binary_sensor.motion"],
+                },
+            }
+            app = Reactive(config, states={"sensor.lux": "5"}, now=1000)
+            app.mock_set_state("binary_sensor.motion", "on")
+            app.mock_advance(10)
+            app.mock_set_state("binary_sensor.motion", "off")
+            app.mock_advance(100)
+            app.mock_set_state("sensor.lux", "50")
+            app.terminate()
+
+            [(header, events)] = replay.read_trace(path)
+            self.assertEqual(header["time"], 1000)
+            self.assertEqual(header["states"]["sensor.lux"], "5")
+            self.assertEqual(events, [
+                [1000, "binary_sensor.motion", None, None, "on"],
+                [1010, "binary_sensor.motion", None, "on", "off"],
+                [1110, "sensor.lux", None, "5", "50"],
+            ])
+
+            app.log("### Replaying the trace issues the same commands")
+            with open(path) as f:
+                recorded = f.read()
+            result = replay.replay(config, header, events)
+            self.assertEqual(result["events"], 3)
+            self.assertEqual(result["commands"], 4)
+            self.assertEqual(result["rules"]["light.b"]["commands"], 2)
+            with open(path) as f:
+                self.assertEqual(f.read(), recorded)
+
+            app.log("### Each run of the app is replayed on its own")
+            app = Reactive(config, states={"sensor.lux": "50"}, now=2000)
+            app.mock_set_state("sensor.lux", "10")
+            app.terminate()
+            runs = replay.read_trace(path)
+            self.assertEqual(len(runs), 2)
+            self.assertEqual(runs[0], (header, events))
+            self.assertEqual(runs[1][0]["time"], 2000)
+            self.assertEqual(runs[1][1], [[2000, "sensor.lux", None, "50", "10"]])
+
+    def test_reconfigure(self):
+        app = Reactive(
+            {
+                "outputs": {
+                    "light.a": ["binary_sensor.a"],
+                    "light.b": ["binary_sensor.b"],
+                    "light.c": ["binary_sensor.c"],
+                }
+            }
+        )
+        app.turn_on("binary_sensor.a")
+        app.mock_states["light.a"] = "off"  # changed outside the script
+        app.mock_service_calls.clear()
+
+        app.log("### Only the changed and new rules are sent")
+        with mock.patch.object(app, "log") as log:
+            app.reconfigure(
+                {
+                    "outputs": {
+                        "light.a": ["binary_sensor.a"],
+                        "light.b": ["binary_sensor.b | binary_sensor.c"],
+                        "light.d": ["!binary_sensor.d"],
+                    }
+                }
+            )
+        log.assert_any_call("2 rules added or changed, 1 removed.")
+        self.assertCountEqual(
+            app.mock_service_calls,
+            [("turn_off", "light.b"), ("turn_on", "light.d")],
+        )
+
+        app.log("### Unchanged rules keep their state")
+        self.assertTrue(app.output_rules["light.a"].last_state)
+
+        app.log("### Listeners of removed entities are removed")
+        self.assertEqual(
+            {e for e, li in app.mock_listeners.items() if li},
+            {"binary_sensor.a", "binary_sensor.b", "binary_sensor.c", "binary_sensor.d",
+             "light.a", "light.b", "light.d"},
+        )
+        for listeners in app.mock_listeners.values():
+            self.assertLessEqual(len(listeners), 1)
+
+        app.turn_on("binary_sensor.c")
+        self.assertEqual(app.mock_states["light.b"], "on")
+        self.assertEqual(app.mock_states["light.c"], "off")
+
+    def test_reconfigure_fetches_new_inputs(self):
+        app = Reactive({"outputs": {"light.a": ["switch.a"]}})
+        app.mock_set_state("switch.b", "on")
+
+        app.log("### Inputs that weren't listened to are fetched")
+        app.reconfigure({"outputs": {"light.a": ["switch.a"], "light.b": ["switch.b"]}})
+        self.assertEqual(app.mock_states["light.b"], "on")
+
+        app.log("### ...also when they were removed and added back")
+        app.reconfigure({"outputs": {"light.a": ["switch.a"]}})
+        app.mock_set_state("switch.b", "off")
+        app.reconfigure({"outputs": {"light.a": ["switch.a"], "light.c": ["!switch.b"]}})
+        self.assertEqual(app.mock_states["light.c"], "on")
+
+    def test_request_reconfigure(self):
+        app = Reactive({"outputs": {"light.a": ["binary_sensor.a"]}})
+
+        app.log("### Requested configurations are applied in the app's own callback")
+        app.request_reconfigure({"outputs": {"light.a": ["!binary_sensor.a"]}})
+        self.assertEqual(app.mock_states["light.a"], "off")
+        app.mock_advance(0)
+        self.assertEqual(app.mock_states["light.a"], "on")
+
+    def test_reconfigure_during_debounce(self):
+        app = Reactive({"debounce": 5, "outputs": {"light.t": ["binary_sensor.m"]}})
+        app.mock_advance(5)
+        app.mock_set_state("binary_sensor.m", "on")
+        app.mock_set_state("binary_sensor.m", "off")
+        app.mock_set_state("binary_sensor.m", "on")
+
+        app.log("### A held back command sends the state of the current rule")
+        app.reconfigure({"debounce": 5, "outputs": {"light.t": ["!binary_sensor.m"]}})
+        app.mock_advance(5)
+        self.assertEqual(app.mock_states["light.t"], "off")
+
+    def test_reconfigure_drops_deferred_commands(self):
+        outputs = {
+            f"light.d{i}": {"inputs": ["binary_sensor.m"], "priority": -1} for i in range(3)
+        }
+        app = Reactive({"low_priority_rate": 1, "outputs": outputs})
+        app.mock_advance(10)
+        app.mock_set_state("binary_sensor.m", "on")
+        deferred = list(app.scheduler.deferred)
+        self.assertEqual(len(deferred), 2)
+
+        app.log("### Removed outputs don't get their deferred commands")
+        kept = {e: rule for e, rule in outputs.items() if e not in deferred}
+        app.reconfigure({"low_priority_rate": 1, "outputs": kept})
+        app.mock_advance(10)
+        for entity in deferred:
+            self.assertEqual(app.mock_states[entity], "off")
+
+    def test_stats(self):
+        app = Reactive(
+            {
+                "stats": {"interval": 60},
+                "outputs": {
+                    "light.a": ["binary_sensor.a & binary_sensor.b"],
+                    "light.b": ["binary_sensor.a"],
+                },
+            }
+        )
+
+        app.turn_on("binary_sensor.a")
+        app.turn_on("binary_sensor.b")
+        app.turn_off("binary_sensor.a")
+
+        summary = app.stats.summary()
+        self.assertEqual(summary["events"], 3)
+        self.assertEqual(summary["state_fetches"], 1)
+        self.assertEqual(summary["inputs"]["binary_sensor.a"]["events"], 2)
+        self.assertEqual(summary["inputs"]["binary_sensor.a"]["changes"], 3)
+        self.assertEqual(summary["outputs"]["light.a"]["evaluations"], 2)
+        self.assertEqual(summary["outputs"]["light.a"]["commands"], 3)
+        self.assertEqual(summary["outputs"]["light.b"]["commands"], 3)
+        self.assertIsNotNone(summary["outputs"]["light.a"]["p95"])
+
+        app.log("### Stats are published as a sensor")
+        app.mock_advance(60)
+        self.assertEqual(app.mock_sensors["sensor.reactive_stats"]["state"], 3)
+
+        app.log("### ...and can be dumped on demand")
+        with tempfile.TemporaryDirectory() as tmp:
+            app.stats_file = os.path.join(tmp, "stats.json")
+            app.fire_event("reactive_dump_stats")
+            with open(app.stats_file) as f:
+                self.assertEqual(json.load(f)["commands"], 6)
+
+    def test_stats_sampling(self):
+        app = Reactive(
+            {"stats": {"sample": 0.25}, "outputs": {"light.a": ["binary_sensor.a"]}}
+        )
+
+        for i in range(8):
+            app.mock_set_state("binary_sensor.a", "on" if i % 2 else "off")
+
+        entry = app.stats.inputs["binary_sensor.a"]
+        self.assertEqual(entry["events"], 8)
+        self.assertEqual(len(entry["times"]), 2)
+
+    def test_what_if(self):
+        app = Reactive(
+            {
+                "outputs": {
+                    "light.a": ["binary_sensor.motion & binary_sensor.dark"],
+                    "light.b": ["!binary_sensor.dark"],
+                }
+            },
+            states={"binary_sensor.dark": "on"},
+        )
+
+        self.assertEqual(
+            app.what_if([{}, {"binary_sensor.motion": "on"}, {"binary_sensor.dark": "off"}]),
+            {"light.a": [False, True, False], "light.b": [False, False, True]},
+        )
+        self.assertNotIn("binary_sensor.motion", app.states.cache)
+
+    def test_time_conditions(self):
+        config = {
+            "outputs": {
+                "light.hallway": ["within:5m binary_sensor.motion"],
+                "switch.fan": ["for:1m binary_sensor.door=open"],
+            }
+        }
+        app = Reactive(config, states={"binary_sensor.door": "closed"})
+        self.assertEqual(app.mock_timers, {})
+
+        app.log("### The light stays on for 5 minutes after the last motion")
+        app.mock_set_state("binary_sensor.motion", "on")
+        app.mock_set_state("binary_sensor.motion", "off")
+        app.mock_advance(200)
+        self.assertEqual(app.mock_states["light.hallway"], "on")
+
+        app.log("### New motion restarts the 5 minutes")
+        app.mock_set_state("binary_sensor.motion", "on")
+        app.mock_set_state("binary_sensor.motion", "off")
+        app.mock_advance(200)
+        self.assertEqual(app.mock_states["light.hallway"], "on")
+
+        app.log("### The door is opened, and all conditions share one timer")
+        app.mock_set_state("binary_sensor.door", "open")
+        self.assertEqual(len(app.mock_timers), 1)
+        app.mock_advance(50)
+        self.assertEqual(app.mock_states["switch.fan"], "off")
+
+        app.log("### Changing the configuration keeps the progress of the timers")
+        app.reconfigure(dict(config, outputs=dict(config["outputs"], **{
+            "light.porch": ["binary_sensor.motion"]})))
+
+        app.mock_advance(10)
+        self.assertEqual(app.mock_states["switch.fan"], "on")
+        self.assertEqual(app.mock_states["light.hallway"], "on")
+        app.mock_advance(50)
+        self.assertEqual(app.mock_states["light.hallway"], "off")
+
+        app.log("### No timers run when no time condition is pending")
+        self.assertEqual(app.mock_timers, {})
+
+    def test_clock_only_read_for_time_conditions(self):
+        app = Reactive({"outputs": {"light.a": ["binary_sensor.motion"],
+                                    "light.b": ["within:1m binary_sensor.door"]}})
+
+        with mock.patch.object(app, "get_now_ts", wraps=app.get_now_ts) as get_now_ts:
+            for _ in range(5):
+                app.mock_set_state("binary_sensor.motion", "on")
+                app.mock_set_state("binary_sensor.motion", "off")
+            self.assertEqual(get_now_ts.call_count, 0)
+
+            app.mock_set_state("binary_sensor.door", "on")
+            self.assertGreater(get_now_ts.call_count, 0)
+
+    def test_comparisons(self):
+        app = Reactive(
+            {
+                "outputs": {
+                    "light.hallway": ["sensor.lux < 20 & binary_sensor.motion"],
+                    "switch.night_light": ["light.hallway.brightness <= 50"],
+                }
+            },
+            states={"sensor.lux": "100", "binary_sensor.motion": "on", "light.hallway": "on"},
+            attributes={"light.hallway": {"brightness": 30}},
+        )
+        self.assertEqual(app.mock_states["light.hallway"], "off")
+        self.assertEqual(app.mock_states["switch.night_light"], "on")
+
+        app.mock_set_state("sensor.lux", "15")
+        self.assertEqual(app.mock_states["light.hallway"], "on")
+
+        app.mock_set_attribute("light.hallway", "brightness", 255)
+        self.assertEqual(app.mock_states["switch.night_light"], "off")
+
+        app.log("### Readings on the same side of the threshold are ignored")
+        app.mock_service_calls.clear()
+        for lux in ("12", "3", "19.9"):
+            app.mock_set_state("sensor.lux", lux)
+        self.assertEqual(app.mock_service_calls, [])
+
+    def test_chained_outputs(self):
+        app = Reactive(
+            {
+                "outputs": {
+                    "switch.nightmode": ["binary_sensor.late & !binary_sensor.guests"],
+                    "switch.quiet": ["switch.nightmode | binary_sensor.baby_sleeping"],
+                    "light.hallway": ["binary_sensor.motion & !switch.nightmode & !switch.quiet"],
+                }
+            },
+            states={"binary_sensor.motion": "on"},
+        )
+        self.assertEqual(app.chain_ranks, {"switch.nightmode": 0, "switch.quiet": 1})
+        self.assertEqual(app.mock_states["light.hallway"], "on")
+
+        app.log("### Dependent rules are evaluated without waiting for HA")
+        app.mock_service = lambda service, entities, state: app.mock_service_calls.append(
+            (service, entities))
+        app.mock_service_calls.clear()
+
+        app.mock_set_state("binary_sensor.late", "on")
+        self.assertEqual(app.mock_service_calls, [
+            ("turn_on", ["switch.nightmode", "switch.quiet"]),
+            ("turn_off", "light.hallway"),
+        ])
+
+        app.log("### The periodic sync sees the actual states of chained outputs")
+        app.mock_service_calls.clear()
+        app.mock_run_hourly()
+        self.assertEqual(app.mock_service_calls, [
+            ("turn_on", ["switch.nightmode", "switch.quiet"]),
+            ("turn_off", "light.hallway"),
+        ])
+
+    def test_chained_outputs_cycle(self):
+        app = Reactive(
+            {
+                "outputs": {
+                    "switch.a": ["switch.b | binary_sensor.a"],
+                    "switch.b": ["switch.a"],
+                    "switch.c": ["switch.b"],
+                    "switch.d": ["binary_sensor.d"],
+                    "light.d": ["switch.d"],
+                }
+            }
+        )
+        self.assertEqual(app.chain_ranks, {"switch.d": 0})
+
+        app.mock_set_state("binary_sensor.a", "on")
+        self.assertEqual(app.mock_states["switch.c"], "on")
+
+    def test_grouped_commands(self):
+        outputs = {f"light.living_room_{i}": ["binary_sensor.motion"] for i in range(3)}
+        outputs["switch.fan"] = ["binary_sensor.motion"]
+        outputs["light.night"] = ["!binary_sensor.motion"]
+        app = Reactive({"outputs": outputs})
+
+        def grouped():
+            return [(service, sorted(entities)) for service, entities in app.mock_grouped_calls]
+
+        self.assertEqual(grouped(), [
+            ("homeassistant/turn_off",
+             ["light.living_room_0", "light.living_room_1", "light.living_room_2", "switch.fan"]),
+        ])
+
+        app.mock_grouped_calls.clear()
+        app.mock_service_calls.clear()
+        app.mock_set_state("binary_sensor.motion", "on")
+
+        self.assertEqual(grouped(), [
+            ("homeassistant/turn_on",
+             ["light.living_room_0", "light.living_room_1", "light.living_room_2", "switch.fan"]),
+        ])
+        self.assertCountEqual(app.mock_service_calls, [
+            ("turn_on", "light.living_room_0"),
+            ("turn_on", "light.living_room_1"),
+            ("turn_on", "light.living_room_2"),
+            ("turn_on", "switch.fan"),
+            ("turn_off", "light.night"),
+        ])
+
+    def test_priority(self):
+        outputs = {f"light.decor{i}": ["binary_sensor.motion"] for i in range(3)}
+        outputs["light.hallway"] = {"inputs": ["binary_sensor.motion"], "priority": 10}
+        app = Reactive({"outputs": outputs})
+        app.mock_service_calls.clear()
+
+        app.mock_set_state("binary_sensor.motion", "on")
+        self.assertEqual(app.mock_service_calls[0], ("turn_on", "light.hallway"))
+        self.assertEqual(len(app.mock_service_calls), 4)
+
+    def test_low_priority_rate_limit(self):
+        outputs = {
+            f"light.decor{i}": {"inputs": ["binary_sensor.motion"], "priority": -1}
+            for i in range(5)
+        }
+        outputs["light.hallway"] = ["binary_sensor.motion"]
+        app = Reactive({"low_priority_rate": 2, "outputs": outputs})
+        app.mock_advance(10)
+        app.mock_service_calls.clear()
+
+        app.log("### Low priority commands beyond the burst are deferred")
+        app.mock_set_state("binary_sensor.motion", "on")
+        self.assertEqual(app.mock_service_calls[0], ("turn_on", "light.hallway"))
+        self.assertEqual(len(app.mock_service_calls), 3)
+
+        app.log("### A deferred output only gets its latest state")
+        app.mock_set_state("binary_sensor.motion", "off")
+        app.mock_service_calls.clear()
+        app.mock_set_state("binary_sensor.motion", "on")
+        self.assertEqual(app.mock_service_calls, [("turn_on", "light.hallway")])
+
+        app.log("### ...and they are sent at the limited rate")
+        app.mock_advance(0.5)
+        self.assertEqual(len(app.mock_service_calls), 2)
+        app.mock_advance(1)
+        self.assertEqual(len(app.mock_service_calls), 4)
+        for i in range(5):
+            self.assertEqual(app.mock_states[f"light.decor{i}"], "on")
+
+
+class TestAsyncReactiveApp(unittest.TestCase):
+    def make_app(self, args):
+        app = AsyncReactive(args)
+        self.addCleanup(lambda: app.mock_loop and app.mock_loop.close())
+        return app
+
+    def test_concurrent_commands(self):
+        app = self.make_app(
+            {
+                "max_concurrent_commands": 3,
+                "outputs": {f"light.test{i}": [f"binary_sensor.switch{i}"] for i in range(6)},
+            }
+        )
+        app.mock_service_calls.clear()
+
+        async def switch_all():
+            await asyncio.gather(*(
+                app.input_changed(f"binary_sensor.switch{i}", None, "off", "on", None)
+                for i in range(6)
+            ))
+
+        app.mock_call(switch_all)
+        self.assertEqual(
+            {e: s for e, s in app.mock_states.items() if e.startswith("light.")},
+            {f"light.test{i}": "on" for i in range(6)},
+        )
+        self.assertEqual(len(app.mock_service_calls), 6)
+        self.assertEqual(app.mock_max_in_flight, 3)
+
+    def test_commands_to_an_output_stay_in_order(self):
+        app = self.make_app({"outputs": {"light.test": ["binary_sensor.switch"]}})
+        app.mock_service_calls.clear()
+
+        async def flap():
+            await asyncio.gather(
+                app.input_changed("binary_sensor.switch", None, "off", "on", None),
+                app.input_changed("binary_sensor.switch", None, "on", "off", None),
+                app.input_changed("binary_sensor.switch", None, "off", "on", None),
+            )
+
+        app.mock_call(flap)
+        self.assertEqual(
+            app.mock_service_calls,
+            [("turn_on", "light.test"), ("turn_off", "light.test"), ("turn_on", "light.test")],
+        )
+        self.assertEqual(app.mock_states["light.test"], "on")
+
+    def test_periodic_sync(self):
+        app = self.make_app(
+            {"outputs": {"light.a": ["binary_sensor.a"], "light.b": ["binary_sensor.b"]}}
+        )
+
+        app.mock_states["light.a"] = "on"
+        app.mock_states["binary_sensor.b"] = "on"  # missed change
+        app.mock_service_calls.clear()
+
+        app.mock_run_hourly()
+        self.assertCountEqual(
+            app.mock_service_calls, [("turn_off", "light.a"), ("turn_on", "light.b")])
+        self.assertEqual(app.mock_states["light.b"], "on")
+
+    def test_output_becomes_available(self):
+        app = self.make_app({"outputs": {"light.test": ["binary_sensor.switch"]}})
+
+        app.mock_set_state("binary_sensor.switch", "on")
+        app.mock_set_state("light.test", "unavailable")
+        app.mock_set_state("light.test", "off")
+        self.assertEqual(app.mock_states["light.test"], "on")
+
+    def test_time_conditions(self):
+        app = self.make_app({"outputs": {"light.hallway": ["within:5m binary_sensor.motion"]}})
+
+        app.mock_set_state("binary_sensor.motion", "on")
+        app.mock_set_state("binary_sensor.motion", "off")
+        app.mock_advance(200)
+        self.assertEqual(app.mock_states["light.hallway"], "on")
+
+        app.mock_advance(100)
+        self.assertEqual(app.mock_states["light.hallway"], "off")
+        self.assertEqual(app.mock_timers, {})
+
+    def test_low_priority_rate_limit(self):
+        outputs = {
+            f"light.decor{i}": {"inputs": ["binary_sensor.motion"], "priority": -1}
+            for i in range(4)
+        }
+        app = self.make_app({"low_priority_rate": 2, "outputs": outputs})
+        app.mock_advance(10)
+        app.mock_service_calls.clear()
+
+        app.mock_set_state("binary_sensor.motion", "on")
+        self.assertEqual(len(app.mock_service_calls), 2)
+        app.mock_advance(1)
+        self.assertEqual(len(app.mock_service_calls), 4)
+
+    def test_availability_rate(self):
+        outputs = {f"light.test{i}": ["binary_sensor.switch"] for i in range(4)}
+        app = self.make_app({"availability_rate": 2, "outputs": outputs})
+        app.mock_set_state("binary_sensor.switch", "on")
+        app.mock_advance(10)
+        app.mock_service_calls.clear()
+
+        for output in outputs:
+            app.mock_set_state(output, "unavailable")
+        for output in outputs:
+            app.mock_set_state(output, "off")
+
+        app.mock_advance(0)
+        self.assertEqual(len(app.mock_service_calls), 2)
+        app.mock_advance(1)
+        self.assertTrue(all(app.mock_states[output] == "on" for output in outputs))
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.jsonl")
+            app = self.make_app(
+                {"trace": path, "outputs": {"light.a": ["binary_sensor.motion"]}})
+            app.mock_advance(10)
+            app.mock_set_state("binary_sensor.motion", "on")
+            app.terminate()
+
+            [(header, events)] = replay.read_trace(path)
+            self.assertEqual(events, [[10, "binary_sensor.motion", None, None, "on"]])
+
+    def test_all_callbacks_run_in_the_loop(self):
+        app = self.make_app({"outputs": {"light.a": ["binary_sensor.a"]}})
+        for callback in (
+            app.input_changed, app.process_batch, app.trigger_all, app.advance_timers,
+            app.resync_output, app.output_becomes_available, app.recover_outputs,
+            app.reconfigure_callback, app.save_snapshot_callback, app.flush_trace_callback,
+            app.publish_stats, app.dump_stats, app.scheduler.drain, app.scheduler.window_closed,
+        ):
+            self.assertTrue(asyncio.iscoroutinefunction(callback), callback)
+
+    def test_request_reconfigure(self):
+        app = self.make_app({"debounce": 5, "outputs": {"light.a": ["binary_sensor.a"]}})
+        app.mock_advance(5)
+        app.mock_set_state("binary_sensor.b", "on")
+        app.mock_set_state("binary_sensor.a", "on")
+        app.mock_set_state("binary_sensor.a", "off")
+
+        app.request_reconfigure({"debounce": 5, "outputs": {"light.a": ["binary_sensor.b"]}})
+        app.mock_advance(5)
+        self.assertEqual(app.mock_states["light.a"], "on")
+
+        app.log("### The listeners are updated")
+        app.mock_set_state("binary_sensor.b", "off")
+        app.mock_advance(5)
+        self.assertEqual(app.mock_states["light.a"], "off")
+        self.assertEqual(
+            {e for e, li in app.mock_listeners.items() if li}, {"binary_sensor.b", "light.a"})